@@ -1,17 +1,33 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-import random
+import copy
 import time
 import json
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import secrets
 import plotly.graph_objects as go
 import plotly.express as px  # Import for colors
 import hashlib
-from copy import deepcopy
+import hmac
+import threading
+import functools
+import logging
 import yfinance as yf
+try:
+    import orjson  # Optional C-accelerated JSON; the stdlib json module is used when missing
+except ImportError:
+    orjson = None
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+logger = logging.getLogger(__name__)
 
 # --- 页面基础设置 ---
 st.set_page_config(page_title="专业投资分析仪表盘", page_icon="🚀", layout="wide")
@@ -23,6 +39,43 @@ SESSION_EXPIRATION_DAYS = 7
 DATA_REFRESH_INTERVAL_SECONDS = 3600  # 1 hour
 BASE_ONEDRIVE_PATH = "root:/Apps/StreamlitDashboard"
 OUNCES_TO_GRAMS = 31.1035
+MAX_FETCH_WORKERS = 8
+PROFILE_FETCH_WORKERS = 5
+TRANSACTIONS_PAGE_SIZE = 25
+GRAPH_BATCH_LIMIT = 20  # Max sub-requests per Graph $batch call
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024  # Graph rejects simple PUT uploads above 4 MB
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024    # Upload-session chunks must be multiples of 320 KiB
+HTTP_TIMEOUT = (3, 10)  # (connect, read) seconds
+YF_TIMEOUT = 10  # Seconds per yfinance request, so one slow symbol can't stall a whole render
+HTTP_USER_AGENT = "StreamlitDashboard/1.0"
+EMAIL_RE = re.compile(r"^[^\s@]+@[^\s@]+\.[^\s@]+$")
+CODE_RE = re.compile(r"^\d{6}$")
+CODE_RESEND_INTERVAL_SECONDS = 30
+# Cache policies, chosen per endpoint by how quickly the data changes
+TTL_NORMAL = 300    # Market quotes
+TTL_LONG = 86400    # Slow-moving reference data (FX rates)
+MARKET_HOURS_TTL = 60    # Quotes while the symbol's exchange is open
+AFTER_HOURS_TTL = 3600   # Quotes while it is closed
+SWR_MAX_STALE_FACTOR = 2  # Background-refreshed values older than this many TTLs are refetched in the foreground
+SWR_MAX_ENTRIES = 256     # Argument tuples kept by stale_while_revalidate, least recently used evicted first
+# Regular sessions as (timezone, open, close) in exchange-local time, keyed by yfinance symbol suffix.
+# Unsuffixed symbols use the US session; so do gold futures, which the dashboard only values by the gram.
+US_MARKET_SESSION = (ZoneInfo("America/New_York"), "09:30", "16:00")
+MARKET_SESSIONS = {
+    ".HK": (ZoneInfo("Asia/Hong_Kong"), "09:30", "16:00"),
+    ".SS": (ZoneInfo("Asia/Shanghai"), "09:30", "15:00"),
+    ".SZ": (ZoneInfo("Asia/Shanghai"), "09:30", "15:00"),
+    ".T": (ZoneInfo("Asia/Tokyo"), "09:00", "15:30"),
+    ".L": (ZoneInfo("Europe/London"), "08:00", "16:30"),
+    ".DE": (ZoneInfo("Europe/Berlin"), "09:00", "17:30"),
+}
+PROFILE_SCHEMA_VERSION = 2  # Profiles below this are normalized by migrate_user_profile on load
+PROFILE_MISS_TTL = 600  # Failed profile lookups are remembered in memory this long, never on disk
+PROFILE_FIELDS = ("shortName", "sector", "currency")  # Subset of Ticker.info the dashboard reads
+HISTORY_SETTLED_DAYS = 2  # Daily bars older than this are final; whole months of them are cached on disk
+HISTORY_SETTLED_CACHE_ENTRIES = 16  # Disk-cached settled blocks; the key moves once a month or when the tickers change
+ONEDRIVE_ETAG_CACHE_MAX_ENTRIES = 512  # OneDrive files kept for conditional GETs, least recently used evicted first
+GRAPH_TOKEN_REFRESH_MARGIN_SECONDS = 60  # Refresh the Graph token this long before it expires
 SECTOR_TRANSLATION = {
     'Technology': '科技',
     'Financial Services': '金融服务',
@@ -43,7 +96,6 @@ if 'logged_in' not in st.session_state: st.session_state.logged_in = False
 if 'user_email' not in st.session_state: st.session_state.user_email = ""
 if 'login_step' not in st.session_state: st.session_state.login_step = "enter_email"
 if 'display_currency' not in st.session_state: st.session_state.display_currency = "USD"
-if 'last_market_data_fetch' not in st.session_state: st.session_state.last_market_data_fetch = 0
 if 'migration_done' not in st.session_state: st.session_state.migration_done = False
 
 # --- API 配置 ---
@@ -54,66 +106,251 @@ ONEDRIVE_SENDER_EMAIL = MS_GRAPH_CONFIG['sender_email']
 CF_CONFIG = st.secrets["cloudflare"]
 
 # --- 核心功能函数定义 ---
+def loads_json(content): return orjson.loads(content) if orjson else json.loads(content)
+
+def dumps_json(data):
+    """Compact UTF-8 JSON bytes; numpy scalars (e.g. prices from yfinance) are serialized as numbers."""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+
+def lru_put(cache, key, value, max_entries):
+    """Inserts into an OrderedDict used as an LRU, evicting the least recently used entries beyond max_entries."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+def script_thread_pool(max_workers):
+    """ThreadPoolExecutor whose workers share the current script-run context, so st.* calls work inside them."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
 def get_email_hash(email): return hashlib.sha256(email.encode('utf-8')).hexdigest()
 
-@st.cache_data(ttl=3500)
+def get_code_hash(email, code): return hashlib.sha256((code + email).encode('utf-8')).hexdigest()
+
+@st.cache_resource
+def http_session():
+    """Shared HTTP session so outbound calls reuse pooled keep-alive connections across reruns."""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    # Identify the app to Graph so throttling and diagnostics can attribute the traffic.
+    session.headers["User-Agent"] = HTTP_USER_AGENT
+    return session
+
+@st.cache_resource
+def graph_token_holder():
+    """Process-wide Graph access token and the time it should be refreshed at."""
+    return {"lock": threading.Lock(), "access_token": None, "refresh_at": 0}
+
 def get_ms_graph_token():
-    url = f"https://login.microsoftonline.com/{MS_GRAPH_CONFIG['tenant_id']}/oauth2/v2.0/token"
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": MS_GRAPH_CONFIG['client_id'],
-        "client_secret": MS_GRAPH_CONFIG['client_secret'],
-        "scope": "https://graph.microsoft.com/.default"
-    }
-    resp = requests.post(url, data=data)
-    resp.raise_for_status()
-    return resp.json()["access_token"]
+    holder = graph_token_holder()
+    with holder["lock"]:
+        if holder["access_token"] and time.time() < holder["refresh_at"]:
+            return holder["access_token"]
+        url = f"https://login.microsoftonline.com/{MS_GRAPH_CONFIG['tenant_id']}/oauth2/v2.0/token"
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": MS_GRAPH_CONFIG['client_id'],
+            "client_secret": MS_GRAPH_CONFIG['client_secret'],
+            "scope": "https://graph.microsoft.com/.default"
+        }
+        resp = http_session().post(url, data=data, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        token_info = loads_json(resp.content)
+        holder["access_token"] = token_info["access_token"]
+        # Honor the lifetime the token endpoint reports instead of assuming one
+        holder["refresh_at"] = time.time() + int(token_info.get("expires_in", 3600)) - GRAPH_TOKEN_REFRESH_MARGIN_SECONDS
+        return holder["access_token"]
 
 def onedrive_api_request(method, path, headers, data=None):
     base_url = f"https://graph.microsoft.com/v1.0/users/{ONEDRIVE_SENDER_EMAIL}/drive"
     url = f"{base_url}/{path}"
-    if method.lower() == 'get': return requests.get(url, headers=headers)
-    if method.lower() == 'put': return requests.put(url, headers=headers, data=data)
+    if method.lower() == 'get': return http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    if method.lower() == 'put': return http_session().put(url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
+    if method.lower() == 'post': return http_session().post(url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
     return None
 
+def upload_onedrive_large(path, body, token, create_only=False):
+    """
+    Uploads a body too big for a simple PUT through a Graph upload session, in sequential chunks.
+    Returns the response to the final chunk, which carries the resulting driveItem, or None when
+    create_only is set and the file already exists.
+    """
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    conflict = "fail" if create_only else "replace"
+    session_body = dumps_json({"item": {"@microsoft.graph.conflictBehavior": conflict}})
+    resp = onedrive_api_request('post', f"{path}:/createUploadSession", headers, data=session_body)
+    if create_only and resp.status_code == 409:
+        return None
+    resp.raise_for_status()
+    upload_url = loads_json(resp.content)["uploadUrl"]
+    total = len(body)
+    for start in range(0, total, UPLOAD_CHUNK_SIZE):
+        chunk = body[start:start + UPLOAD_CHUNK_SIZE]
+        # The upload URL is pre-authenticated; Graph asks for no Authorization header here.
+        chunk_headers = {"Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{total}"}
+        resp = http_session().put(upload_url, headers=chunk_headers, data=chunk, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+    return resp
+
+@st.cache_resource
+def onedrive_etag_cache():
+    """LRU of the last seen ETag and raw body per OneDrive path, {path: (etag, content)}, for conditional GETs."""
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def etag_cache_get(path):
+    cache = onedrive_etag_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(path)
+        if entry is not None:
+            cache["entries"].move_to_end(path)
+        return entry
+
+def etag_cache_put(path, etag, content):
+    cache = onedrive_etag_cache()
+    with cache["lock"]:
+        lru_put(cache["entries"], path, (etag, content), ONEDRIVE_ETAG_CACHE_MAX_ENTRIES)
+
+def etag_cache_pop(path):
+    cache = onedrive_etag_cache()
+    with cache["lock"]:
+        cache["entries"].pop(path, None)
+
+def fetch_onedrive_data(path, is_json=True):
+    """Downloads and decodes a OneDrive file, or returns None if it doesn't exist. Other failures raise."""
+    token = get_ms_graph_token()
+    headers = {"Authorization": f"Bearer {token}"}
+    cached = etag_cache_get(path)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    resp = onedrive_api_request('get', f"{path}:/content", headers)
+    if resp.status_code == 304 and cached:
+        # Unchanged since the last download; reuse the cached bytes.
+        content = cached[1]
+    elif resp.status_code == 404:
+        # This is not an error, just means the file doesn't exist yet.
+        etag_cache_pop(path)
+        return None
+    else:
+        resp.raise_for_status()
+        content = resp.content
+        etag = resp.headers.get("ETag")
+        if etag:
+            etag_cache_put(path, etag, content)
+    return loads_json(content) if is_json else content.decode('utf-8')
+
 def get_onedrive_data(path, is_json=True):
     try:
-        token = get_ms_graph_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        resp = onedrive_api_request('get', f"{path}:/content", headers)
-        if resp.status_code == 404:
-            # This is not an error, just means the file doesn't exist yet.
-            return None
-        resp.raise_for_status()
-        return resp.json() if is_json else resp.text
-    except requests.exceptions.RequestException as e:
+        return fetch_onedrive_data(path, is_json)
+    # ValueError covers an empty or corrupt body: JSON and UTF-8 decode errors both subclass it.
+    except (requests.exceptions.RequestException, ValueError) as e:
         st.error(f"从 OneDrive 加载数据失败 ({path}): {e}")
         return None
 
-def save_onedrive_data(path, data):
-    try:
-        token = get_ms_graph_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-        json_data = json.dumps(data, indent=2, ensure_ascii=False)
-        onedrive_api_request('put', f"{path}:/content", headers, data=json_data.encode('utf-8'))
+def put_onedrive_data(path, data, create_only=False):
+    """
+    Uploads data as JSON to path and raises on failure. With create_only the write is skipped
+    server-side when the file already exists (Graph answers 409), which saves a separate existence
+    GET; that case returns False.
+    """
+    token = get_ms_graph_token()
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    body = dumps_json(data)
+    cached = etag_cache_get(path)
+    if cached and cached[1] == body:
+        # Byte-identical to the copy last read from or written to OneDrive; nothing to upload.
         return True
+    if len(body) > SIMPLE_UPLOAD_LIMIT:
+        resp = upload_onedrive_large(path, body, token, create_only)
+        if resp is None:
+            return False
+    else:
+        conflict = "fail" if create_only else "replace"
+        resp = onedrive_api_request('put', f"{path}:/content?@microsoft.graph.conflictBehavior={conflict}", headers, data=body)
+        if create_only and resp.status_code == 409:
+            return False
+        resp.raise_for_status()
+    # Seed the conditional-GET cache with what we just wrote so the next read can be a 304.
+    etag = loads_json(resp.content).get("eTag")
+    if etag:
+        etag_cache_put(path, etag, body)
+    else:
+        etag_cache_pop(path)
+    return True
+
+def save_onedrive_data(path, data, create_only=False):
+    """put_onedrive_data that reports a failed upload on the page and returns False instead of raising."""
+    try:
+        return put_onedrive_data(path, data, create_only)
     except Exception as e:
         st.error(f"保存数据到 OneDrive 失败 ({path}): {e}")
         return False
 
+def graph_batch(sub_requests):
+    """
+    Sends Graph sub-requests through the JSON $batch endpoint, at most 20 per round trip.
+    Each sub-request is a dict with id, method, url (relative to /v1.0) and optional headers/body.
+    Returns {id: response}, where each response carries status, headers and body.
+    """
+    token = get_ms_graph_token()
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    responses = {}
+    for i in range(0, len(sub_requests), GRAPH_BATCH_LIMIT):
+        resp = http_session().post("https://graph.microsoft.com/v1.0/$batch", headers=headers, data=dumps_json({"requests": sub_requests[i:i + GRAPH_BATCH_LIMIT]}), timeout=30)
+        resp.raise_for_status()
+        for sub_response in loads_json(resp.content).get("responses", []):
+            responses[sub_response["id"]] = sub_response
+    return responses
+
+def save_onedrive_data_batch(items, create_only_paths=()):
+    """
+    Writes several OneDrive JSON files in a single $batch round trip. items is a list of (path, data).
+    Paths in create_only_paths are never replaced: if the file already exists that write fails (409).
+    """
+    sub_requests = [
+        {"id": str(i), "method": "PUT", "url": f"/users/{ONEDRIVE_SENDER_EMAIL}/drive/{path}:/content?@microsoft.graph.conflictBehavior={'fail' if path in create_only_paths else 'replace'}", "headers": {"Content-Type": "application/json"}, "body": data}
+        for i, (path, data) in enumerate(items, 1)
+    ]
+    try:
+        responses = graph_batch(sub_requests)
+        failed = [path for i, (path, _) in enumerate(items, 1) if not 200 <= responses.get(str(i), {}).get("status", 0) < 300]
+        if failed:
+            raise RuntimeError(f"写入失败: {', '.join(failed)}")
+        return True
+    except Exception as e:
+        st.error(f"保存数据到 OneDrive 失败: {e}")
+        return False
+    finally:
+        # These writes bypass save_onedrive_data, so forget the cached copies rather than trust them.
+        for path, _ in items:
+            etag_cache_pop(path)
+
+def get_user_profile_path(email): return f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json"
+
+def get_global_data_path(file_name): return f"{BASE_ONEDRIVE_PATH}/{file_name}.json"
+
 def get_user_profile(email):
-    return get_onedrive_data(f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json")
+    """
+    Reads a profile through the ETag cache: an unchanged file costs a 304 with no body, and each call
+    returns a freshly parsed copy the caller may mutate. Deliberately not st.cache_data, which would
+    pickle the whole dict on every hit and serve edits from other devices up to a TTL late.
+    """
+    return get_onedrive_data(get_user_profile_path(email))
 
 def save_user_profile(email, data):
-    return save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/users/{get_email_hash(email)}.json", data)
+    return save_onedrive_data(get_user_profile_path(email), data)
+
+def invalidate_user_profile():
+    """Forgets the session copy, so the next run reloads the profile (a conditional GET)."""
+    st.session_state.pop('user_profile', None)
 
 def get_global_data(file_name):
-    data = get_onedrive_data(f"{BASE_ONEDRIVE_PATH}/{file_name}.json")
+    data = get_onedrive_data(get_global_data_path(file_name))
     return data if data else {}
 
-def save_global_data(file_name, data):
-    return save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/{file_name}.json", data)
-
 def send_verification_code(email, code):
     try:
         token = get_ms_graph_token()
@@ -127,45 +364,91 @@ def send_verification_code(email, code):
             },
             "saveToSentItems": "true"
         }
-        requests.post(url, headers=headers, json=payload, timeout=10).raise_for_status()
+        http_session().post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT).raise_for_status()
         return True
     except Exception as e:
         st.error(f"邮件发送失败: {e}")
         return False
 
+@st.cache_resource
+def code_store():
+    """
+    Process-wide store of pending verification codes, {email: (code_hash, expires_at)}.
+    Codes only live for minutes, so they are kept in memory instead of on OneDrive.
+    """
+    return {"lock": threading.Lock(), "codes": {}, "last_sent": {}}
+
+def prune_code_store(store, now):
+    """Drops expired codes and stale resend timestamps so abandoned sign-ins don't accumulate. Call with the lock held."""
+    store["codes"] = {email: info for email, info in store["codes"].items() if info[1] > now}
+    store["last_sent"] = {email: sent for email, sent in store["last_sent"].items() if now - sent < CODE_RESEND_INTERVAL_SECONDS}
+
 def handle_send_code(email):
-    if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
+    if not EMAIL_RE.fullmatch(email):
         st.sidebar.error("请输入有效的邮箱地址。")
         return
-    codes = get_global_data("codes")
-    code = str(random.randint(100000, 999999))
-    codes[email] = {"code": code, "expires_at": time.time() + 300} # 5-minute expiration
-    if not save_global_data("codes", codes) or not send_verification_code(email, code):
+    store = code_store()
+    with store["lock"]:
+        if time.time() - store["last_sent"].get(email, 0) < CODE_RESEND_INTERVAL_SECONDS:
+            st.sidebar.warning("验证码发送过于频繁，请稍后再试。")
+            return
+    code = f"{secrets.randbelow(900000) + 100000:06d}"
+    # Send first so a mail failure aborts before any state is persisted.
+    if not send_verification_code(email, code):
         return
+    with store["lock"]:
+        now = time.time()
+        prune_code_store(store, now)
+        store["codes"][email] = (get_code_hash(email, code), now + 300) # 5-minute expiration
+        store["last_sent"][email] = now
     st.sidebar.success("验证码已发送，请查收。")
     st.session_state.login_step = "enter_code"
     st.session_state.temp_email = email
     st.rerun()
 
 def handle_verify_code(email, code):
-    codes = get_global_data("codes")
-    code_info = codes.get(email)
-    if not code_info or time.time() > code_info["expires_at"]:
+    # Reject malformed input before spending a OneDrive round-trip on it.
+    if not CODE_RE.fullmatch(code):
+        st.sidebar.error("验证码错误。")
+        return
+    store = code_store()
+    with store["lock"]:
+        code_info = store["codes"].get(email)
+    if not code_info or time.time() > code_info[1]:
         st.sidebar.error("验证码已过期或不存在。")
         return
-    if code_info["code"] == code:
-        if not get_user_profile(email):
-            new_profile = {"role": "user", "portfolio": {"stocks": [], "cash_accounts": [], "crypto": [], "liabilities": [], "transactions": [], "gold": []}}
-            save_user_profile(email, new_profile)
-            st.toast("🎉 欢迎新用户！已为您创建账户。")
-        
-        sessions = get_global_data("sessions")
+    if hmac.compare_digest(code_info[0], get_code_hash(email, code)):
+        # The profile check and the sessions read are independent; overlap the two OneDrive GETs.
+        # Both use the raising fetch: only a 404 may read as "missing", since a missing profile is
+        # created and sessions.json is rewritten from what was read.
+        with script_thread_pool(2) as executor:
+            profile_future = executor.submit(fetch_onedrive_data, get_user_profile_path(email))
+            sessions_future = executor.submit(fetch_onedrive_data, get_global_data_path("sessions"))
+        try:
+            is_new_user = profile_future.result() is None
+            stored_sessions = sessions_future.result() or {}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            st.sidebar.error(f"读取账户数据失败，请稍后重试: {e}")
+            return
+        now = time.time()
+        # Drop expired sessions while rewriting the file anyway, so sessions.json stays bounded.
+        sessions = {t: info for t, info in stored_sessions.items() if info.get("expires_at", 0) > now}
         token = secrets.token_hex(16)
-        sessions[token] = {"email": email, "expires_at": time.time() + (SESSION_EXPIRATION_DAYS * 24 * 60 * 60)}
-        save_global_data("sessions", sessions)
+        sessions[token] = {"email": email, "expires_at": now + (SESSION_EXPIRATION_DAYS * 24 * 60 * 60)}
+        
+        # Write the session (and the profile for new users) in one Graph round trip
+        writes = [(get_global_data_path("sessions"), sessions)]
+        if is_new_user:
+            new_profile = {"role": "user", "schema_version": PROFILE_SCHEMA_VERSION, "portfolio": {"stocks": [], "cash_accounts": [], "crypto": [], "liabilities": [], "transactions": [], "gold": []}}
+            writes.append((get_user_profile_path(email), new_profile))
+        # Create-only, so a profile that appeared since the read (or was misread) is never replaced.
+        if not save_onedrive_data_batch(writes, create_only_paths={get_user_profile_path(email)}):
+            return
+        if is_new_user:
+            st.toast("🎉 欢迎新用户！已为您创建账户。")
         
-        del codes[email]
-        save_global_data("codes", codes)
+        with store["lock"]:
+            store["codes"].pop(email, None)
         
         st.session_state.logged_in = True
         st.session_state.user_email = email
@@ -173,8 +456,7 @@ def handle_verify_code(email, code):
         st.query_params["session_token"] = token
         
         # --- MODIFICATION: Clear profile on new login to force re-fetch ---
-        if 'user_profile' in st.session_state:
-            del st.session_state.user_profile
+        invalidate_user_profile()
             
         st.rerun()
     else:
@@ -194,121 +476,356 @@ def check_session_from_query_params():
         st.session_state.login_step = "logged_in"
         
         # --- MODIFICATION: Clear profile on session resume to force re-fetch ---
-        if 'user_profile' in st.session_state:
-            del st.session_state.user_profile
+        invalidate_user_profile()
             
     elif "session_token" in st.query_params:
         st.query_params.clear()
 
-@st.cache_data(ttl=86400)  # Cache for 24 hours
+@st.cache_resource
+def background_refresh_state():
+    """Values served by stale_while_revalidate, an LRU of {key: (value, fetched_at)}, plus the keys being refreshed."""
+    return {"lock": threading.Lock(), "values": OrderedDict(), "refreshing": set()}
+
+def stale_while_revalidate(ttl):
+    """
+    Caches a function's result per argument tuple. Once a value is older than ttl it is still
+    returned immediately while a background thread fetches a fresh one, so callers polling more
+    often than ttl rarely wait on the network. A value older than SWR_MAX_STALE_FACTOR * ttl is
+    too old to serve even once; that call fetches in the foreground, like the very first one.
+    None results are not cached. ttl may also be a callable taking the same arguments.
+    wrapper.refresh(*args) skips the cache for one call and stores what it fetched.
+    The refresh thread carries the caller's script-run context, but that run may be over by the
+    time the fetch ends, so wrapped functions report problems through the logger, not st.*.
+    """
+    def decorator(func):
+        def fetch(key, args):
+            state = background_refresh_state()
+            started = time.time()
+            value = func(*args)
+            if value is not None:
+                with state["lock"]:
+                    # A fetch that started later (e.g. a forced refresh) may have landed first; keep the newer one.
+                    current = state["values"].get(key)
+                    if current is None or current[1] <= started:
+                        lru_put(state["values"], key, (value, started), SWR_MAX_ENTRIES)
+            return value
+
+        def refresh(key, args):
+            try:
+                fetch(key, args)
+            except Exception as e:
+                # Keep serving the stale value; the next expired read retries
+                logger.warning("Background refresh of %s failed: %s", func.__qualname__, e)
+            finally:
+                with background_refresh_state()["lock"]:
+                    background_refresh_state()["refreshing"].discard(key)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            state = background_refresh_state()
+            key = (func.__qualname__, args)
+            max_age = ttl(*args) if callable(ttl) else ttl
+            with state["lock"]:
+                entry = state["values"].get(key)
+                if entry is not None:
+                    state["values"].move_to_end(key)
+                    age = time.time() - entry[1]
+                    if age > max_age * SWR_MAX_STALE_FACTOR:
+                        entry = None
+                start_refresh = entry is not None and age > max_age and key not in state["refreshing"]
+                if start_refresh:
+                    state["refreshing"].add(key)
+            if entry is None:
+                return fetch(key, args)
+            if start_refresh:
+                thread = threading.Thread(target=refresh, args=(key, args), daemon=True)
+                add_script_run_ctx(thread, get_script_run_ctx())
+                thread.start()
+            return entry[0]
+
+        wrapper.refresh = lambda *args: fetch((func.__qualname__, args), args)
+        return wrapper
+    return decorator
+
+@stale_while_revalidate(TTL_LONG)
 def get_exchange_rates():
     try:
-        resp = requests.get(f"https://open.er-api.com/v6/latest/USD")
+        resp = http_session().get("https://open.er-api.com/v6/latest/USD", timeout=HTTP_TIMEOUT)
         resp.raise_for_status()
         data = resp.json()
         return data.get("rates") if data.get("result") == "success" else None
     except Exception as e:
-        st.error(f"获取汇率失败: {e}")
+        # May run on a background refresh thread; the dashboard reports missing rates itself.
+        logger.warning("Exchange rate fetch failed: %s", e)
         return None
 
+def to_yf_crypto_ticker(symbol): return f"{symbol.strip().upper()}-USD"
+
+def get_portfolio_yf_tickers(stock_tickers, crypto_symbols):
+    """
+    Returns a sorted, de-duplicated tuple of yfinance symbols for the portfolio.
+    A tuple with a stable order keeps the market-data cache key identical across reruns.
+    Blank symbols left behind by the editors are skipped rather than requested.
+    """
+    stock_set = {t for t in stock_tickers if t}
+    crypto_set = {to_yf_crypto_ticker(c) for c in crypto_symbols if c and c.strip()}
+    return tuple(sorted(stock_set | crypto_set | {"GC=F"}))
+
 def get_prices_from_market_data(market_data, tickers):
+    """Maps quotes back to portfolio symbols in one pass, returning (prices, tickers without a price)."""
     prices = {}
+    failed = []
     for t in tickers:
-        original_ticker = t.replace('-USD', '')
-        prices[original_ticker] = market_data.get(t, {}).get("latest_price", 0)
-    return prices
+        price = market_data.get(t, {}).get("latest_price", 0)
+        prices[t.replace('-USD', '')] = price
+        if price == 0:
+            failed.append(t)
+    return prices, failed
+
+@st.cache_data(persist="disk", show_spinner=False)
+def fetch_stock_profile_yf(symbol):
+    """
+    Company profile fields the dashboard uses, kept on disk so restarts don't refetch them.
+    Streamlit ignores TTLs on disk-persisted caches; sector and trading currency are effectively
+    static, so that is acceptable here. Raises on failure so a miss is never persisted.
+    Uses a fresh Ticker, not get_yf_ticker: a Ticker keeps its first .info result, failures included.
+    """
+    info = yf.Ticker(symbol).info
+    if not (info and info.get('shortName')):
+        raise ValueError(f"No profile returned for {symbol}")
+    return {key: info.get(key) for key in PROFILE_FIELDS}
 
-@st.cache_data(ttl=86400)
+@st.cache_data(ttl=PROFILE_MISS_TTL, show_spinner=False)
 def get_stock_profile_yf(symbol):
+    """Profile or None. The in-memory TTL keeps reruns from re-querying Yahoo for a symbol that just failed."""
     try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        if info and info.get('shortName'):
-            return info
+        return fetch_stock_profile_yf(symbol)
     except Exception:
         return None
-    return None
 
-@st.cache_data(ttl=300) # Cache for 5 minutes
+def get_stock_profiles_yf(symbols):
+    """
+    Profiles for several symbols, looked up concurrently. Ticker.info takes no timeout, so the wait
+    is bounded here instead: a lookup still running after its YF_TIMEOUT share counts as None, and
+    the pool is not joined, so the render moves on (the lookup still fills the cache when it ends).
+    """
+    if not symbols:
+        return {}
+    workers = min(PROFILE_FETCH_WORKERS, len(symbols))
+    executor = script_thread_pool(workers)
+    futures = {symbol: executor.submit(get_stock_profile_yf, symbol) for symbol in symbols}
+    deadline = time.time() + YF_TIMEOUT * -(-len(symbols) // workers)
+    profiles = {}
+    for symbol, future in futures.items():
+        try:
+            profiles[symbol] = future.result(timeout=max(0, deadline - time.time()))
+        except FutureTimeoutError:
+            logger.warning("Profile lookup for %s timed out", symbol)
+            profiles[symbol] = None
+    executor.shutdown(wait=False, cancel_futures=True)
+    return profiles
+
+@st.cache_resource(show_spinner=False)
+def get_yf_ticker(symbol):
+    """Shared yfinance Ticker per symbol for history() calls, built once per process instead of on every fetch."""
+    return yf.Ticker(symbol)
+
+@st.cache_data(ttl=TTL_NORMAL, show_spinner=False)
+def fetch_latest_quote_yf(symbol):
+    # Only the last two closes are read, so skip the dividend/split columns.
+    closes = get_yf_ticker(symbol).history(period="2d", actions=False, timeout=YF_TIMEOUT)['Close']
+    if closes.empty:
+        # Raise instead of returning None so an empty response is not cached.
+        raise ValueError(f"No price history returned for {symbol}")
+    return {
+        "latest_price": closes.iloc[-1],
+        "previous_close": closes.iloc[-2] if len(closes) > 1 else closes.iloc[-1]
+    }
+
+def fetch_bulk_quotes_yf(symbols):
+    """
+    Downloads recent closes for all symbols in a single yfinance request.
+    Symbols missing from the response are simply absent from the result.
+    """
+    hist = yf.download(list(symbols), period="5d", progress=False, timeout=YF_TIMEOUT)
+    if hist.empty:
+        return {}
+    closes = hist['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(name=symbols[0])
+    data = {}
+    for symbol in closes.columns:
+        # Drop NaN rows per symbol: crypto trades on days when exchanges are closed.
+        series = closes[symbol].dropna()
+        if series.empty:
+            continue
+        data[symbol] = {
+            "latest_price": series.iloc[-1],
+            "previous_close": series.iloc[-2] if len(series) > 1 else series.iloc[-1]
+        }
+    return data
+
+def symbol_quote_ttl(symbol, now):
+    """Crypto trades around the clock and refreshes every 5 minutes; listed symbols every minute during their exchange's session, hourly outside it."""
+    if symbol.endswith("-USD"):
+        return TTL_NORMAL
+    suffix = symbol[symbol.rfind("."):] if "." in symbol else ""
+    tz, market_open, market_close = MARKET_SESSIONS.get(suffix, US_MARKET_SESSION)
+    local = now.astimezone(tz)
+    if local.weekday() < 5 and market_open <= local.strftime("%H:%M") < market_close:
+        return MARKET_HOURS_TTL
+    return AFTER_HOURS_TTL
+
+def market_data_ttl(symbols):
+    """
+    TTL for a quote tuple: the shortest of its symbols' TTLs. Quotes are cached per tuple because
+    one bulk download serves the whole portfolio, so the tuple refreshes as often as its most
+    active market needs.
+    """
+    now = datetime.now(ZoneInfo("UTC"))
+    return min((symbol_quote_ttl(symbol, now) for symbol in symbols), default=AFTER_HOURS_TTL)
+
+@stale_while_revalidate(market_data_ttl)
 def get_market_data_yf(symbols):
     """
     Fetches the latest market data for a list of symbols using yfinance.
+    All symbols are first requested in one batch download; any symbols it
+    misses are downloaded concurrently one by one.
     """
     if not symbols:
         return {}
     
-    data = {}
+    # yfinance surfaces transport errors from its own HTTP backend as well as pandas/parsing
+    # errors, so the net stays broad here; the reason is logged rather than swallowed.
     try:
-        tickers = yf.Tickers(symbols)
-        
-        if len(symbols) == 1:
-            # Handle the single ticker case, which has a different structure
-            ticker_obj = tickers.tickers[symbols[0]]
-            hist = ticker_obj.history(period="2d")
-            if not hist.empty:
-                data[symbols[0]] = {
-                    "latest_price": hist['Close'].iloc[-1],
-                    "previous_close": hist['Close'].iloc[-2] if len(hist) > 1 else hist['Close'].iloc[-1]
-                }
-        else:
-            # Handle the multiple tickers case
-            for symbol, ticker_obj in tickers.tickers.items():
-                hist = ticker_obj.history(period="2d")
-                if not hist.empty:
-                    data[symbol] = {
-                        "latest_price": hist['Close'].iloc[-1],
-                        "previous_close": hist['Close'].iloc[-2] if len(hist) > 1 else hist['Close'].iloc[-1]
-                    }
+        data = fetch_bulk_quotes_yf(symbols)
     except Exception as e:
-        st.warning(f"yfinance data fetch failed for some tickers: {e}")
+        logger.warning("Bulk quote download failed for %s: %s", ", ".join(symbols), e)
+        data = {}
+
+    remaining = [symbol for symbol in symbols if symbol not in data]
+    failed = []
+    if remaining:
+        with script_thread_pool(min(MAX_FETCH_WORKERS, len(remaining))) as executor:
+            futures = {executor.submit(fetch_latest_quote_yf, symbol): symbol for symbol in remaining}
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    quote = future.result()
+                except Exception as e:
+                    logger.warning("Quote fetch failed for %s: %s", symbol, e)
+                    quote = None
+                if quote:
+                    data[symbol] = quote
+                else:
+                    failed.append(symbol)
+    if failed:
+        # May run on a background refresh thread; the dashboard warns about unpriced tickers itself.
+        logger.warning("yfinance data fetch failed for some tickers: %s", ", ".join(sorted(failed)))
     
     return data
 
+@st.cache_data(ttl=DATA_REFRESH_INTERVAL_SECONDS, show_spinner=False)
 def get_asset_history(email):
-    history = []
-    try:
-        token = get_ms_graph_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        email_hash = get_email_hash(email)
-        path = f"{BASE_ONEDRIVE_PATH}/history/{email_hash}:/children"
-        resp = onedrive_api_request('get', path, headers)
-        if resp.status_code == 404:
-            return []
-        resp.raise_for_status()
-        files = resp.json().get('value', [])
-        for file in files:
-            file_path = f"{BASE_ONEDRIVE_PATH}/history/{email_hash}/{file['name']}"
-            snapshot = get_onedrive_data(file_path)
-            if snapshot:
-                history.append(snapshot)
-    except Exception:
+    """
+    All of a user's daily snapshots, oldest first. Any failed request raises instead of returning
+    an empty or partial list, because st.cache_data would otherwise keep that result for the full TTL.
+    """
+    token = get_ms_graph_token()
+    headers = {"Authorization": f"Bearer {token}"}
+    email_hash = get_email_hash(email)
+    path = f"{BASE_ONEDRIVE_PATH}/history/{email_hash}:/children"
+    resp = onedrive_api_request('get', path, headers)
+    if resp.status_code == 404:
         return []
+    resp.raise_for_status()
+    files = loads_json(resp.content).get('value', [])
+    history = []
+    for file in files:
+        file_path = f"{BASE_ONEDRIVE_PATH}/history/{email_hash}/{file['name']}"
+        snapshot = fetch_onedrive_data(file_path)
+        if snapshot is None:
+            raise FileNotFoundError(f"Listed snapshot {file_path} could not be downloaded")
+        history.append(snapshot)
     return sorted(history, key=lambda x: x['date'])
 
-def get_closest_snapshot(target_date, asset_history):
-    if not asset_history: return None
-    target_date_str = target_date.strftime('%Y-%m-%d')
-    relevant_snapshots = [s for s in asset_history if s['date'] <= target_date_str]
-    if not relevant_snapshots: return None
-    return max(relevant_snapshots, key=lambda x: x['date'])
+@st.cache_resource
+def background_executor():
+    """Process-wide pool for writes nobody needs to wait on, such as the daily snapshot."""
+    return ThreadPoolExecutor(max_workers=2)
 
-def update_asset_snapshot(email, user_profile, total_assets_usd, total_liabilities_usd, total_stock_value_usd, total_cash_balance_usd, total_crypto_value_usd, total_gold_value_usd, current_rates):
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    if not get_onedrive_data(f"{BASE_ONEDRIVE_PATH}/history/{get_email_hash(email)}/{today_str}.json"):
+@st.cache_resource
+def snapshot_written_dates():
+    """Process-wide {email_hash: date} of the last snapshot known to exist, so new sessions skip the write."""
+    return {"lock": threading.Lock(), "dates": {}}
+
+def write_asset_snapshot(email_hash, snapshot):
+    """
+    Runs off the script thread: writes today's snapshot unless another session already did, which
+    returns False. Either way the date is recorded in snapshot_written_dates. Failures raise into
+    the future; check_snapshot_write reports them on a later run.
+    The cached history is left as is rather than re-downloaded: the chart stops at yesterday,
+    and snapshot_written_dates already covers today's existence check.
+    """
+    created = put_onedrive_data(f"{BASE_ONEDRIVE_PATH}/history/{email_hash}/{snapshot['date']}.json", snapshot, create_only=True)
+    written = snapshot_written_dates()
+    with written["lock"]:
+        # One entry per user; older dates are dropped as users write again.
+        written["dates"] = {h: d for h, d in written["dates"].items() if d == snapshot['date']}
+        written["dates"][email_hash] = snapshot['date']
+    return created
+
+def check_snapshot_write():
+    """Reports a finished background snapshot write; on failure the marker is cleared so this run queues it again."""
+    future = st.session_state.get('snapshot_future')
+    if future is None or not future.done():
+        return
+    del st.session_state.snapshot_future
+    error = future.exception()
+    if error is not None:
+        st.session_state.pop('snapshot_submitted_for', None)
+        st.error(f"今日资产快照保存失败，将重试: {error}")
+    elif future.result():
         st.toast("今日资产快照已生成！")
-        snapshot = {
-            "date": today_str,
-            "total_assets_usd": total_assets_usd,
-            "total_liabilities_usd": total_liabilities_usd,
-            "net_worth_usd": total_assets_usd - total_liabilities_usd,
-            "total_stock_value_usd": total_stock_value_usd,
-            "total_cash_balance_usd": total_cash_balance_usd,
-            "total_crypto_value_usd": total_crypto_value_usd,
-            "total_gold_value_usd": total_gold_value_usd,
-            "exchange_rates": current_rates,
-            "portfolio": user_profile["portfolio"]
-        }
-        save_onedrive_data(f"{BASE_ONEDRIVE_PATH}/history/{get_email_hash(email)}/{today_str}.json", snapshot)
+
+def snapshot_exchange_rates(portfolio, rates):
+    """Only the rates a snapshot's holdings can need (plus USD), rounded; the full table is ~160 currencies."""
+    used = {"USD"}
+    for key in ("stocks", "cash_accounts", "liabilities"):
+        used.update(item.get("currency") or "USD" for item in portfolio.get(key, []))
+    return {currency: round(float(rates[currency]), 6) for currency in used if currency in rates}
+
+def update_asset_snapshot(email, user_profile, asset_history, total_assets_usd, total_liabilities_usd, total_stock_value_usd, total_cash_balance_usd, total_crypto_value_usd, total_gold_value_usd, current_rates):
+    check_snapshot_write()
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    # The history loaded for this run already tells us whether today's snapshot exists;
+    # only ask OneDrive when it is missing there.
+    if asset_history and asset_history[-1]['date'] == today_str:
+        return
+    # The history cache only updates once the background write lands; don't queue it again meanwhile,
+    # from this session or, once it has landed, from any other.
+    if st.session_state.get('snapshot_submitted_for') == (email, today_str):
+        return
+    email_hash = get_email_hash(email)
+    written = snapshot_written_dates()
+    with written["lock"]:
+        if written["dates"].get(email_hash) == today_str:
+            return
+    snapshot = {
+        "date": today_str,
+        "total_assets_usd": total_assets_usd,
+        "total_liabilities_usd": total_liabilities_usd,
+        "net_worth_usd": total_assets_usd - total_liabilities_usd,
+        "total_stock_value_usd": total_stock_value_usd,
+        "total_cash_balance_usd": total_cash_balance_usd,
+        "total_crypto_value_usd": total_crypto_value_usd,
+        "total_gold_value_usd": total_gold_value_usd,
+        "exchange_rates": snapshot_exchange_rates(user_profile["portfolio"], current_rates),
+        # A copy: later reruns edit the session's portfolio in place while the write thread serializes this.
+        "portfolio": copy.deepcopy(user_profile["portfolio"])
+    }
+    st.session_state.snapshot_submitted_for = (email, today_str)
+    st.session_state.snapshot_future = background_executor().submit(write_asset_snapshot, email_hash, snapshot)
 
 @st.cache_data(ttl=3600)
 def get_detailed_ai_analysis(prompt):
@@ -317,88 +834,161 @@ def get_detailed_ai_analysis(prompt):
         url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/{model}"
         headers = {"Authorization": f"Bearer {api_token}"}
         payload = {"prompt": prompt, "stream": False, "max_tokens": 2048}
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = http_session().post(url, headers=headers, json=payload, timeout=60)
         response.raise_for_status()
         return response.json().get("result", {}).get("response", "AI 分析时出现错误或超时。")
     except Exception as e:
         return f"无法连接到 AI 服务进行分析: {e}"
 
+def download_closes(tickers, start_date, end_date):
+    """Daily closes for tickers over [start_date, end_date] as a date-indexed frame, one column per ticker."""
+    hist = yf.download(list(tickers), start=start_date, end=end_date + timedelta(days=1), progress=False, threads=True, timeout=YF_TIMEOUT)
+    if hist.empty:
+        return pd.DataFrame()
+    closes = hist['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(name=tickers[0])
+    return closes
+
+def next_month_start(day): return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+class IncompleteClosesError(ValueError):
+    """Raised by get_settled_closes when held tickers have no data, carrying the partial frame so it can be used uncached."""
+    def __init__(self, closes, missing):
+        super().__init__(f"No closes returned for {', '.join(missing)}")
+        self.closes = closes
+
+@st.cache_data(persist="disk", max_entries=HISTORY_SETTLED_CACHE_ENTRIES, show_spinner=False)
+def get_settled_closes(tickers, start_date, end_date, _required_tickers=()):
+    """
+    Settled closes from start_date through end_date, the last day of a month, in one download kept
+    on disk across restarts. Only complete results are persisted: an empty download raises, and so
+    does one missing any of _required_tickers (those held by then), since a failed symbol in a
+    multi-ticker download comes back as an all-NaN column that would undervalue the chart for good.
+    """
+    closes = download_closes(tickers, start_date, end_date)
+    if closes.empty:
+        raise ValueError(f"No closes returned for {start_date} to {end_date}")
+    missing = [t for t in _required_tickers if t not in closes.columns or closes[t].isna().all()]
+    if missing:
+        raise IncompleteClosesError(closes, missing)
+    return closes
+
+@st.cache_data(ttl=TTL_NORMAL, show_spinner=False)
+def get_recent_closes(tickers, start_date, end_date):
+    return download_closes(tickers, start_date, end_date)
+
+def get_historical_closes(tickers, start_date, end_date, first_held):
+    """
+    Daily closes for a sorted ticker tuple. Everything through the last whole month that ended more
+    than HISTORY_SETTLED_DAYS ago is one disk-cached block, so a cold start is a single download and
+    the key only moves once a month. The rest (at most about a month, with bars that may still be
+    revised) is downloaded again once the short TTL expires. first_held maps each ticker to the first
+    date it was held; tickers held by the end of the settled block must have data for it to persist.
+    """
+    settled_through = min(end_date, datetime.now().date() - timedelta(days=HISTORY_SETTLED_DAYS))
+    settled_month = settled_through.replace(day=1)
+    if next_month_start(settled_month) - timedelta(days=1) > settled_through:
+        settled_month = (settled_month - timedelta(days=1)).replace(day=1)
+    settled_end = next_month_start(settled_month) - timedelta(days=1)
+    parts = []
+    recent_start = start_date
+    if settled_end >= start_date:
+        first_month = start_date.replace(day=1)
+        required = tuple(t for t in tickers if t in first_held and first_held[t] <= settled_end)
+        try:
+            parts.append(get_settled_closes(tickers, first_month, settled_end, _required_tickers=required))
+        except IncompleteClosesError as e:
+            # Use what arrived for this run only; the next load downloads the block again.
+            logger.warning("Settled closes not cached: %s", e)
+            parts.append(e.closes)
+        recent_start = settled_end + timedelta(days=1)
+    if recent_start <= end_date:
+        parts.append(get_recent_closes(tickers, recent_start, end_date))
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return pd.DataFrame()
+    closes = pd.concat(parts).sort_index()
+    # The settled block starts on the 1st; drop the days before start_date so the result matches the range asked for.
+    closes = closes[closes.index >= pd.Timestamp(start_date)]
+    return closes[~closes.index.duplicated(keep='last')]
+
+def value_snapshot_over_days(snapshot, closes):
+    """
+    Values one snapshot's holdings on every day in closes (rows are days, columns tickers) as
+    matrix operations. Cash and liabilities use the snapshot's own FX rates and do not vary by day.
+    Missing prices count as zero, as do gold prices that are missing or non-positive.
+    """
+    portfolio = snapshot.get('portfolio', {})
+    rates_series = pd.Series(snapshot.get('exchange_rates', {}), dtype=np.float64)
+
+    stocks = pd.DataFrame(portfolio.get("stocks", []), columns=['ticker', 'quantity', 'currency'])
+    stock_weights = stocks['quantity'].fillna(0).to_numpy(dtype=np.float64) / stocks['currency'].fillna('USD').map(rates_series).fillna(1).to_numpy(dtype=np.float64)
+    stock_value = np.nansum(closes.reindex(columns=stocks['ticker'].tolist()).to_numpy(dtype=np.float64) * stock_weights, axis=1)
+
+    crypto = pd.DataFrame(portfolio.get("crypto", []), columns=['symbol', 'quantity'])
+    crypto_prices = closes.reindex(columns=[to_yf_crypto_ticker(c) for c in crypto['symbol']]).to_numpy(dtype=np.float64)
+    crypto_value = np.nansum(crypto_prices * crypto['quantity'].fillna(0).to_numpy(dtype=np.float64), axis=1)
+
+    gold_grams = pd.DataFrame(portfolio.get("gold", []), columns=['grams'])['grams'].fillna(0).sum()
+    gold_price = closes['GC=F'] if 'GC=F' in closes.columns else pd.Series(np.nan, index=closes.index)
+    gold_value = gold_grams * (gold_price / OUNCES_TO_GRAMS).where(gold_price > 0, 0).to_numpy(dtype=np.float64)
+
+    cash_value = balances_to_usd(portfolio.get("cash_accounts", []), rates_series).sum()
+    liabilities_value = balances_to_usd(portfolio.get("liabilities", []), rates_series).sum()
+    return pd.DataFrame({
+        'net_worth_usd': stock_value + crypto_value + gold_value + cash_value - liabilities_value,
+        'stock_value_usd': stock_value,
+        'crypto_value_usd': crypto_value,
+        'gold_value_usd': gold_value,
+        'cash_value_usd': cash_value,
+    }, index=closes.index)
+
 @st.cache_data(ttl=1800)
-def get_detailed_history_df(_asset_history_tuples, start_date, end_date):
+def get_detailed_history_df(history_key, _asset_history, start_date, end_date):
     """
     Calculates detailed historical asset values.
-    Accepts a tuple of tuples for caching and converts it back to a list of dicts.
+    The snapshot list itself is not hashed (leading underscore); history_key, the owner's email
+    hash plus the snapshot dates, identifies it instead, since a day's snapshot is written once.
     """
-    if not _asset_history_tuples:
+    if not _asset_history:
         return pd.DataFrame()
-
-    # --- FIX: Convert the hashable tuple back to a list of dicts ---
-    _asset_history = [dict(s) for s in _asset_history_tuples]
     
-    all_historical_tickers = set()
+    # Every ticker ever held, with the first snapshot date holding it (snapshots are sorted by date)
+    first_held = {"GC=F": datetime.strptime(_asset_history[0]['date'], '%Y-%m-%d').date()}
     for snapshot in _asset_history:
+        snapshot_date = datetime.strptime(snapshot['date'], '%Y-%m-%d').date()
         portfolio = snapshot.get('portfolio', {})
-        for s in portfolio.get("stocks", []): all_historical_tickers.add(s['ticker'])
-        for c in portfolio.get("crypto", []): all_historical_tickers.add(f"{c['symbol'].upper()}-USD")
-    all_historical_tickers.add("GC=F")
+        for s in portfolio.get("stocks", []): first_held.setdefault(s['ticker'], snapshot_date)
+        for c in portfolio.get("crypto", []): first_held.setdefault(to_yf_crypto_ticker(c['symbol']), snapshot_date)
     
-    hist_prices_df = yf.download(list(all_historical_tickers), start=start_date, end=end_date + timedelta(days=1), progress=False)
-    if hist_prices_df.empty:
+    # Always download from the first snapshot, not the chosen start date, so moving the start date
+    # reuses the cached closes instead of fetching a new range; earlier closes also seed the ffill.
+    history_start = min(datetime.strptime(_asset_history[0]['date'], '%Y-%m-%d').date(), start_date)
+    close_prices = get_historical_closes(tuple(sorted(first_held)), history_start, end_date, first_held)
+    if close_prices.empty:
         return pd.DataFrame()
 
-    daily_values_data = []
     all_dates = pd.date_range(start=start_date, end=end_date, freq='D')
-
-    for date in all_dates:
-        # get_closest_snapshot now receives the corrected list of dicts
-        snapshot = get_closest_snapshot(date.date(), _asset_history)
-        if not snapshot: continue
-
-        portfolio = snapshot.get('portfolio', {})
-        exchange_rates = snapshot.get('exchange_rates', {})
-
-        try:
-            prices_series = hist_prices_df['Close'].loc[date.strftime('%Y-%m-%d')]
-        except KeyError:
-            temp_df = hist_prices_df[hist_prices_df.index < date]
-            if not temp_df.empty:
-                prices_series = temp_df['Close'].iloc[-1]
-            else:
-                continue
-
-        stock_holdings = portfolio.get("stocks", [])
-        crypto_holdings = portfolio.get("crypto", [])
-        gold_holdings = portfolio.get("gold", [])
-        cash_accounts = portfolio.get("cash_accounts", [])
-        liabilities = portfolio.get("liabilities", [])
-
-        gold_price_per_ounce = prices_series.get("GC=F", 0)
-        gold_price_per_gram = (gold_price_per_ounce / OUNCES_TO_GRAMS) if pd.notna(gold_price_per_ounce) and gold_price_per_ounce > 0 else 0
-
-        stock_value_usd = sum(s.get('quantity',0) * prices_series.get(s['ticker'], 0) / exchange_rates.get(s.get('currency', 'USD'), 1) for s in stock_holdings if pd.notna(prices_series.get(s['ticker'])))
-        crypto_value_usd = sum(c.get('quantity',0) * prices_series.get(f"{c['symbol'].upper()}-USD", 0) for c in crypto_holdings if pd.notna(prices_series.get(f"{c['symbol'].upper()}-USD")))
-        gold_value_usd = sum(g.get('grams', 0) * gold_price_per_gram for g in gold_holdings)
-        cash_value_usd = sum(acc.get('balance',0) / exchange_rates.get(acc.get('currency', 'USD'), 1) for acc in cash_accounts)
-        liabilities_usd = sum(liab.get('balance',0) / exchange_rates.get(liab.get('currency', 'USD'), 1) for liab in liabilities)
-        
-        assets_usd = stock_value_usd + crypto_value_usd + gold_value_usd + cash_value_usd
-        net_worth_usd = assets_usd - liabilities_usd
-
-        daily_values_data.append({
-            'date': date,
-            'net_worth_usd': net_worth_usd,
-            'stock_value_usd': stock_value_usd,
-            'crypto_value_usd': crypto_value_usd,
-            'gold_value_usd': gold_value_usd,
-            'cash_value_usd': cash_value_usd,
-        })
-    
-    if not daily_values_data:
+    # Align once to the calendar: each day takes that day's close, or the last close before it.
+    daily_closes = close_prices.reindex(all_dates, method='ffill')
+    first_price_date = close_prices.index[0]
+    # Same idea for snapshots: one vectorized search maps every day to the latest snapshot on or before it
+    # (ISO date strings sort chronologically), instead of formatting and searching per day.
+    history_dates = np.array([s['date'] for s in _asset_history])
+    snapshot_positions = np.searchsorted(history_dates, np.asarray(all_dates.strftime('%Y-%m-%d')), side='right') - 1
+    valid_days = (snapshot_positions >= 0) & (all_dates >= first_price_date)
+
+    # Value each snapshot's holdings over all the days it covers at once, instead of day by day.
+    frames = [
+        value_snapshot_over_days(_asset_history[pos], daily_closes[valid_days & (snapshot_positions == pos)])
+        for pos in np.unique(snapshot_positions[valid_days])
+    ]
+    if not frames:
         return pd.DataFrame()
-        
-    df = pd.DataFrame(daily_values_data)
-    df['date'] = pd.to_datetime(df['date'])
-    return df.set_index('date').sort_index()
+    df = pd.concat(frames)
+    df.index.name = 'date'
+    return df.sort_index()
 
 def display_login_form():
     with st.sidebar:
@@ -415,6 +1005,70 @@ def display_login_form():
                 st.session_state.login_step = "enter_email"
                 st.rerun()
 
+def balances_to_usd(accounts, rates_series):
+    """Per-account balances converted to USD as one NumPy array (cash accounts or liabilities)."""
+    df = pd.DataFrame(accounts, columns=['currency', 'balance'])
+    rates = df['currency'].fillna('USD').map(rates_series).fillna(1).to_numpy(dtype=np.float64)
+    return df['balance'].fillna(0).to_numpy(dtype=np.float64) / rates
+
+def stock_values_to_usd(stock_holdings, prices, rates_series):
+    """Per-holding stock market values in USD as one NumPy array, in portfolio order."""
+    df = pd.DataFrame(stock_holdings, columns=['ticker', 'quantity', 'currency'])
+    price = df['ticker'].map(prices).fillna(0).to_numpy(dtype=np.float64)
+    rates = df['currency'].fillna('USD').map(rates_series).fillna(1).to_numpy(dtype=np.float64)
+    return df['quantity'].fillna(0).to_numpy(dtype=np.float64) * price / rates
+
+def crypto_values_to_usd(crypto_holdings, prices):
+    """Per-holding crypto market values as one NumPy array; crypto is priced in USD."""
+    df = pd.DataFrame(crypto_holdings, columns=['symbol', 'quantity'])
+    return df['quantity'].fillna(0).to_numpy(dtype=np.float64) * df['symbol'].map(prices).fillna(0).to_numpy(dtype=np.float64)
+
+def format_amounts(values, symbols=""):
+    """Formats a numeric Series as thousands-separated amounts, optionally prefixed with per-row currency symbols."""
+    # astype(object) keeps an empty result string-typed, so prefixing a plain "$" still works.
+    return symbols + values.map('{:,.2f}'.format).astype(object)
+
+def build_pl_columns(quantity, price, cost, symbols):
+    """Vectorized cost / price / value / unrealized P&L columns shared by the holdings tables."""
+    value = quantity * price
+    cost_basis = quantity * cost
+    pl = value - cost_basis
+    return_pct = (pl / cost_basis * 100).where(cost_basis > 0, 0)
+    return {
+        "成本价": format_amounts(cost, symbols),
+        "现价": format_amounts(price, symbols),
+        "市值": format_amounts(value, symbols),
+        "未实现盈亏": format_amounts(pl, symbols),
+        "回报率(%)": return_pct.map('{:.2f}%'.format),
+    }
+
+def build_stock_table(stock_holdings, prices):
+    holdings = pd.DataFrame(stock_holdings, columns=['ticker', 'quantity', 'currency', 'average_cost'])
+    symbols = holdings['currency'].fillna('USD').map(CURRENCY_SYMBOLS).fillna('')
+    price = holdings['ticker'].map(prices).fillna(0)
+    table = pd.DataFrame({"代码": holdings['ticker'], "数量": holdings['quantity'], "货币": holdings['currency']})
+    return table.assign(**build_pl_columns(holdings['quantity'].fillna(0), price, holdings['average_cost'].fillna(0), symbols))
+
+def build_crypto_table(crypto_holdings, prices):
+    holdings = pd.DataFrame(crypto_holdings, columns=['symbol', 'quantity', 'average_cost'])
+    quantity = holdings['quantity'].fillna(0)
+    table = pd.DataFrame({"代码": holdings['symbol'], "数量": quantity.map('{:.6f}'.format)})
+    return table.assign(**build_pl_columns(quantity, holdings['symbol'].map(prices).fillna(0), holdings['average_cost'].fillna(0), "$"))
+
+def build_gold_table(gold_holdings, price_per_gram):
+    holdings = pd.DataFrame(gold_holdings, columns=['grams', 'average_cost_per_gram'])
+    grams = holdings['grams'].fillna(0)
+    price = pd.Series(price_per_gram, index=holdings.index, dtype=np.float64)
+    pl_columns = build_pl_columns(grams, price, holdings['average_cost_per_gram'].fillna(0), "$")
+    table = pd.DataFrame({"资产": "黄金", "克数 (g)": grams})
+    return table.assign(**{"成本价 ($/g)": pl_columns.pop("成本价"), "现价 ($/g)": pl_columns.pop("现价")}, **pl_columns)
+
+def build_balance_table(accounts, name_label, amount_label, with_symbol=True):
+    """Table for cash accounts or liabilities, with balances formatted in each row's own currency."""
+    df = pd.DataFrame(accounts, columns=['name', 'currency', 'balance'])
+    symbols = df['currency'].map(CURRENCY_SYMBOLS).fillna('') if with_symbol else ""
+    return pd.DataFrame({name_label: df['name'], "货币": df['currency'], amount_label: format_amounts(df['balance'], symbols)})
+
 def display_asset_allocation_chart(stock_usd, cash_usd, crypto_usd, gold_usd, display_curr, display_rate, display_symbol):
     labels, values_usd = ['股票', '现金', '加密货币', '黄金'], [stock_usd, cash_usd, crypto_usd, gold_usd]
     non_zero_labels, non_zero_values = [l for l, v in zip(labels, values_usd) if v > 0.01], [v for v in values_usd if v > 0.01]
@@ -431,10 +1085,216 @@ def display_asset_allocation_chart(stock_usd, cash_usd, crypto_usd, gold_usd, di
     fig.update_layout(title_text='资产配置', showlegend=False, height=300, margin=dict(l=10, r=10, t=40, b=10))
     st.plotly_chart(fig, use_container_width=True)
 
+def migrate_user_profile(user_profile):
+    """
+    Brings a freshly loaded profile up to PROFILE_SCHEMA_VERSION in place. Runs once per load rather
+    than on every rerun; the version tag is persisted with the next save, so no extra write is made.
+    """
+    if user_profile.get("schema_version", 1) >= PROFILE_SCHEMA_VERSION:
+        return
+    user_portfolio = user_profile.setdefault("portfolio", {})
+    for key in ["stocks", "cash_accounts", "crypto", "liabilities", "transactions", "gold"]:
+        user_portfolio.setdefault(key, [])
+    user_profile["schema_version"] = PROFILE_SCHEMA_VERSION
+
+def commit_user_profile(user_profile, success_message):
+    """
+    Saves an edited profile and reruns. The session copy is updated first so the rerun does not
+    race the OneDrive write; the success message is shown as a toast on the next run instead of
+    holding this one open with a sleep.
+    """
+    st.session_state.user_profile = user_profile
+    if save_user_profile(st.session_state.user_email, user_profile):
+        st.session_state.flash_message = success_message
+        st.rerun()
+
+@st.fragment
+def display_transaction_log(transactions):
+    """Paginated transaction table; paging reruns only this fragment, not the whole dashboard."""
+    if transactions:
+        # Render one page at a time so the table cost stays constant as the history grows.
+        total_pages = -(-len(transactions) // TRANSACTIONS_PAGE_SIZE)
+        page = 1
+        if total_pages > 1:
+            page = st.number_input(f"页码 (共 {total_pages} 页)", min_value=1, max_value=total_pages, value=1, step=1, key="transactions_page")
+        sorted_transactions = sorted(transactions, key=lambda tx: tx.get("date", ""), reverse=True)
+        page_transactions = sorted_transactions[(page - 1) * TRANSACTIONS_PAGE_SIZE:page * TRANSACTIONS_PAGE_SIZE]
+        transactions_df = pd.DataFrame(page_transactions)
+        
+        # Format columns for better display
+        if 'symbol' not in transactions_df.columns: transactions_df['symbol'] = pd.NA
+        if 'quantity' not in transactions_df.columns: transactions_df['quantity'] = pd.NA
+        if 'realized_pl' not in transactions_df.columns: transactions_df['realized_pl'] = pd.NA
+        if 'pl_currency' not in transactions_df.columns: transactions_df['pl_currency'] = pd.NA
+        
+        display_cols = ["date", "type", "description", "amount", "currency", "account", "symbol", "quantity", "realized_pl", "pl_currency"]
+        # Filter out columns that are entirely empty
+        display_cols = [col for col in display_cols if col in transactions_df.columns and not transactions_df[col].isnull().all()]
+        
+        st.table(transactions_df[display_cols])
+    else:
+        st.write("暂无交易记录。")
+
+@st.fragment
+def display_history_chart(history_df, display_curr, display_rate, display_symbol):
+    """History trend chart; switching the chart type reruns only this fragment."""
+    st.subheader("📈 资产历史趋势")
+
+    chart_type = st.radio(
+        "选择图表类型",
+        ('市值', '回报率 (%)'),
+        horizontal=True,
+        key='history_chart_type'
+    )
+
+    if history_df.empty or len(history_df.index) < 2:
+        st.info("历史数据不足（少于2天），无法生成图表。")
+    else:
+        with st.spinner("正在生成历史趋势图..."):
+            plot_df = history_df.copy()
+            
+            if chart_type == '回报率 (%)':
+                # Normalize data to show percentage change
+                plot_df = (plot_df / plot_df.iloc[0]) * 100
+                yaxis_title = "回报率 (%)"
+                hovertemplate_prefix = ""
+                hovertemplate_suffix = "%"
+            else: # Default is '市值'
+                plot_df = plot_df.mul(display_rate)
+                yaxis_title = f"市值 ({display_symbol})"
+                hovertemplate_prefix = display_symbol
+                hovertemplate_suffix = f" {display_curr}"
+
+            fig = go.Figure()
+            categories = {
+                'net_worth_usd': '总净资产',
+                'stock_value_usd': '股票',
+                'crypto_value_usd': '加密货币',
+                'gold_value_usd': '黄金',
+                'cash_value_usd': '现金'
+            }
+            
+            # Store colors to match text with lines
+            colors = px.colors.qualitative.Plotly
+            
+            for i, (key, name) in enumerate(categories.items()):
+                color = colors[i % len(colors)]
+                fig.add_trace(go.Scatter(
+                    x=plot_df.index,
+                    y=plot_df[key],
+                    mode='lines',
+                    name=name,
+                    line=dict(color=color), # Assign color
+                    hovertemplate=f"日期: %{{x|%Y-%m-%d}}<br>{name}: {hovertemplate_prefix}%{{y:,.2f}}{hovertemplate_suffix}<extra></extra>"
+                ))
+
+                # Add text label for the last point
+                last_val = plot_df[key].iloc[-1]
+                text_label = f"{hovertemplate_prefix}{last_val:,.2f}{hovertemplate_suffix}"
+                if chart_type == '回报率 (%)':
+                     text_label = f"{last_val:,.2f}{hovertemplate_suffix}"
+
+                fig.add_trace(go.Scatter(
+                    x=[plot_df.index[-1]],
+                    y=[last_val],
+                    text=[text_label],
+                    mode='text',
+                    textposition='middle right',
+                    textfont=dict(color=color, size=12),
+                    showlegend=False,
+                    hoverinfo='none'
+                ))
+            
+            fig.update_layout(
+                title_text=f"资产{chart_type}历史趋势",
+                yaxis_title=yaxis_title,
+                hovermode="x unified",
+                margin=dict(r=100) # Add right margin to make space for text
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
+@st.fragment
+def display_ai_analysis(stock_df, gold_df, crypto_df, cash_accounts, liabilities, total_assets_usd, total_liabilities_usd, net_worth_usd, display_curr, display_rate, display_symbol):
+    """AI analysis tab; the button reruns only this fragment instead of reloading prices and profile."""
+    st.subheader("🤖 AI 深度分析")
+    st.info("此功能会将您匿名的持仓明细发送给AI进行全面分析，以提供更具洞察力的建议。")
+    
+    if st.button("开始 AI 分析"):
+        # The markdown tables and prompt are only needed once analysis is requested, not on every rerun.
+        stock_table = stock_df.to_markdown(index=False)
+        gold_table = gold_df.to_markdown(index=False)
+        crypto_table = crypto_df.to_markdown(index=False)
+        cash_table = build_balance_table(cash_accounts, "账户名称", "余额", with_symbol=False).to_markdown(index=False)
+        liabilities_table = build_balance_table(liabilities, "名称", "金额", with_symbol=False).to_markdown(index=False)
+
+        prompt = f"""# 角色
+你是一位资深、专业的中文投资组合分析师。你的任务是为客户提供详细、专业且易于理解的投资组合诊断报告。
+
+# 输出要求
+- **语言**: 全程必须使用**简体中文**进行分析和回答。
+- **格式**: 使用Markdown格式，分点阐述，条理清晰。
+- **语气**: 专业、客观、鼓励，并提供可执行的建议。
+- **详细程度**: 对每个分析要点进行详细阐述，不要只给出结论，要解释原因。
+
+# 核心分析任务
+请根据下面提供的匿名投资组合数据，完成一份详细的诊断报告，报告需包含以下部分：
+1.  **总体概览**: 对当前资产规模、净资产、负债水平和资产构成进行简要总结。
+2.  **投资组合优点 (Strengths)**: 找出当前持仓中值得肯定的地方（例如，良好的多元化、持有了优质资产等）。
+3.  **潜在风险与弱点 (Weaknesses & Risks)**: 识别并详细说明当前投资组合存在的问题，例如：
+    * **集中度风险**: 是否有单一资产（股票或加密货币）或单一行业占比过高？
+    * **流动性分析**: 现金及高流动性资产的比例是否合理？
+    * **资产质量**: 持仓中低、中、高风险资产的比例？预期收益率和亏损概率分别是多少？
+4.  **具体优化建议**: 提供3-5条具体的、可立即执行的调整建议。例如：“建议考虑减持部分 [某股票]，因为它在您的投资组合中占比已超过XX%，风险过于集中。可以将资金再平衡到 [某行业/ETF] 以提高多元化。”
+
+---
+
+# 客户的匿名投资组合数据
+(所有金额单位均为 {display_curr})
+
+## 财务摘要
+- **总资产**: {display_symbol}{total_assets_usd * display_rate:,.2f}
+- **总负债**: {display_symbol}{total_liabilities_usd * display_rate:,.2f}
+- **净资产**: {display_symbol}{net_worth_usd * display_rate:,.2f}
+
+## 详细持仓
+
+### 股票持仓
+{stock_table}
+
+### 黄金持仓
+{gold_table}
+
+### 加密货币持仓
+{crypto_table}
+
+### 现金账户
+{cash_table}
+
+### 负债情况
+{liabilities_table}
+"""
+        with st.spinner("正在调用 AI 进行深度分析，请稍候..."):
+            analysis_result = get_detailed_ai_analysis(prompt)
+            st.markdown(analysis_result)
+
+
 def display_dashboard():
     st.title(f"🚀 {st.session_state.user_email} 的专业仪表盘")
-    asset_history = get_asset_history(st.session_state.user_email)
+    flash_message = st.session_state.pop('flash_message', None)
+    if flash_message:
+        st.toast(flash_message)
+    try:
+        asset_history = get_asset_history(st.session_state.user_email)
+    except Exception as e:
+        # Nothing is cached for a failed load, so the next rerun tries again.
+        st.error(f"加载资产历史失败: {e}")
+        asset_history = []
     
+    force_refresh = st.sidebar.button('🔄 刷新市场数据')
+    if force_refresh:
+        # --- MODIFICATION: Force re-fetch of profile on manual refresh ---
+        invalidate_user_profile()
+
     # --- MODIFICATION: Load from session_state if available, else fetch ---
     # This prevents the race condition where OneDrive save is slower than the rerun.
     if 'user_profile' not in st.session_state:
@@ -442,70 +1302,58 @@ def display_dashboard():
         if st.session_state.user_profile is None:
              st.error("无法加载用户数据。")
              st.stop()
+        migrate_user_profile(st.session_state.user_profile)
 
     # Use the session state version for this run
     user_profile = st.session_state.user_profile
     # --- END MODIFICATION ---
     
-    user_portfolio = user_profile.setdefault("portfolio", {})
-    for key in ["stocks", "cash_accounts", "crypto", "liabilities", "transactions", "gold"]:
-        user_portfolio.setdefault(key, [])
+    user_portfolio = user_profile["portfolio"]
     
-    stock_tickers = [s['ticker'] for s in user_portfolio.get("stocks", [])]
-    crypto_symbols = [c['symbol'] for c in user_portfolio.get("crypto", [])]
-    
-    last_fetched_tickers = st.session_state.get('last_fetched_tickers', set())
-    current_tickers = set(stock_tickers + crypto_symbols)
-    tickers_changed = current_tickers != last_fetched_tickers
-    
-    if st.sidebar.button('🔄 刷新市场数据'):
-        st.session_state.last_market_data_fetch = 0
-        # --- MODIFICATION: Force re-fetch of profile on manual refresh ---
-        if 'user_profile' in st.session_state:
-            del st.session_state.user_profile
-    
-    now = time.time()
+    stock_holdings = user_portfolio.get("stocks", [])
+    cash_accounts = user_portfolio.get("cash_accounts", [])
+    crypto_holdings = user_portfolio.get("crypto", [])
+    liabilities = user_portfolio.get("liabilities", [])
+    gold_holdings = user_portfolio.get("gold", [])
+
+    stock_tickers = [s['ticker'] for s in stock_holdings]
+    crypto_symbols = [c['symbol'] for c in crypto_holdings]
     
-    if tickers_changed or (now - st.session_state.last_market_data_fetch > DATA_REFRESH_INTERVAL_SECONDS):
-        with st.spinner("正在获取最新市场数据..."):
-            y_crypto_tickers = [f"{s.upper()}-USD" for s in crypto_symbols]
-            all_yf_tickers = list(set(stock_tickers + y_crypto_tickers + ["GC=F"]))
-            st.session_state.market_data = get_market_data_yf(all_yf_tickers)
-            st.session_state.exchange_rates = get_exchange_rates()
-            st.session_state.last_market_data_fetch = now
-            st.session_state.last_fetched_tickers = current_tickers
-            st.rerun()
-
-    market_data = st.session_state.get('market_data', {})
-    exchange_rates = st.session_state.get('exchange_rates', {})
+    all_yf_tickers = get_portfolio_yf_tickers(stock_tickers, crypto_symbols)
+    # Both calls are cheap in-memory reads once warm; their own TTLs decide when to go to the network.
+    with st.spinner("正在获取最新市场数据..."):
+        if force_refresh:
+            # Refetch only this portfolio's symbols; the caches are shared by every session.
+            for symbol in all_yf_tickers:
+                fetch_latest_quote_yf.clear(symbol)
+            market_data = get_market_data_yf.refresh(all_yf_tickers)
+        else:
+            market_data = get_market_data_yf(all_yf_tickers)
+    exchange_rates = get_exchange_rates()
     if not exchange_rates:
         st.error("无法加载汇率，资产总值不准确。")
         st.stop()
+    # Rates as a float Series, built once per run, so per-row currency lookups are a vectorized index
+    rates_series = pd.Series(exchange_rates, dtype=np.float64)
 
-    prices = get_prices_from_market_data(market_data, stock_tickers + crypto_symbols + ["GC=F"])
-    
-    failed_tickers = [ticker for ticker in (stock_tickers + [f"{c}-USD" for c in crypto_symbols] + ["GC=F"]) if prices.get(ticker.replace('-USD', ''), 0) == 0]
+    prices, failed_tickers = get_prices_from_market_data(market_data, all_yf_tickers)
     if failed_tickers:
         st.warning(f"警告：未能获取以下资产的价格，其市值可能显示为0: {', '.join(failed_tickers)}")
     
     gold_price_per_ounce = prices.get("GC=F", 0)
     gold_price_per_gram = gold_price_per_ounce / OUNCES_TO_GRAMS if gold_price_per_ounce > 0 else 0
 
-    stock_holdings = user_portfolio.get("stocks", [])
-    cash_accounts = user_portfolio.get("cash_accounts", [])
-    crypto_holdings = user_portfolio.get("crypto", [])
-    liabilities = user_portfolio.get("liabilities", [])
-    gold_holdings = user_portfolio.get("gold", [])
 
-    total_stock_value_usd = sum(s.get('quantity',0) * prices.get(s['ticker'], 0) / exchange_rates.get(s.get('currency', 'USD'), 1) for s in stock_holdings)
-    total_cash_balance_usd = sum(acc.get('balance',0) / exchange_rates.get(acc.get('currency', 'USD'), 1) for acc in cash_accounts)
-    total_crypto_value_usd = sum(c.get('quantity',0) * prices.get(c['symbol'], 0) for c in crypto_holdings)
-    total_gold_value_usd = sum(g.get('grams', 0) * gold_price_per_gram for g in gold_holdings)
+    stock_values_usd = stock_values_to_usd(stock_holdings, prices, rates_series)
+    total_stock_value_usd = stock_values_usd.sum()
+    total_cash_balance_usd = balances_to_usd(cash_accounts, rates_series).sum()
+    total_crypto_value_usd = crypto_values_to_usd(crypto_holdings, prices).sum()
+    total_gold_value_usd = pd.DataFrame(gold_holdings, columns=['grams'])['grams'].fillna(0).to_numpy(dtype=np.float64).sum() * gold_price_per_gram
     total_assets_usd = total_stock_value_usd + total_cash_balance_usd + total_crypto_value_usd + total_gold_value_usd
-    total_liabilities_usd = sum(liab.get('balance',0) / exchange_rates.get(liab.get('currency', 'USD'), 1) for liab in liabilities)
+    total_liabilities_usd = balances_to_usd(liabilities, rates_series).sum()
     net_worth_usd = total_assets_usd - total_liabilities_usd
     
-    update_asset_snapshot(st.session_state.user_email, user_profile, total_assets_usd, total_liabilities_usd, total_stock_value_usd, total_cash_balance_usd, total_crypto_value_usd, total_gold_value_usd, exchange_rates)
+    update_asset_snapshot(st.session_state.user_email, user_profile, asset_history, total_assets_usd, total_liabilities_usd, total_stock_value_usd, total_cash_balance_usd, total_crypto_value_usd, total_gold_value_usd, exchange_rates)
 
     display_curr = st.sidebar.selectbox("选择显示货币", options=SUPPORTED_CURRENCIES, index=SUPPORTED_CURRENCIES.index(st.session_state.display_currency))
     st.session_state.display_currency = display_curr # Remember choice
@@ -518,9 +1366,14 @@ def display_dashboard():
     if default_start_date < min_date: default_start_date = min_date
     start_date = st.sidebar.date_input("开始日期", value=default_start_date, min_value=min_date, max_value=max_date)
 
-    # Convert asset_history to a hashable type for caching
-    asset_history_tuples = tuple(map(tuple, (s.items() for s in asset_history)))
-    history_df = get_detailed_history_df(asset_history_tuples, start_date, max_date - timedelta(days=1))
+    # A cheap cache key for the history instead of hashing every snapshot's full contents
+    history_key = (get_email_hash(st.session_state.user_email), tuple(s['date'] for s in asset_history))
+    try:
+        history_df = get_detailed_history_df(history_key, asset_history, start_date, max_date - timedelta(days=1))
+    except Exception as e:
+        # A failed price download raises rather than being cached; the next rerun retries it.
+        st.warning(f"历史价格加载失败，暂时无法显示历史走势: {e}")
+        history_df = pd.DataFrame()
     
     # Append today's data to the history for a complete chart
     if not history_df.empty:
@@ -575,9 +1428,9 @@ def display_dashboard():
             col2.metric("💰 总资产", f"{display_symbol}{total_assets_usd * display_rate:,.2f} {display_curr}")
             col3.metric("💳 总负债", f"{display_symbol}{total_liabilities_usd * display_rate:,.2f} {display_curr}")
 
-    stock_df_data = [{"代码": s['ticker'], "数量": s['quantity'], "货币": s['currency'], "成本价": f"{CURRENCY_SYMBOLS.get(s.get('currency', 'USD'), '')}{s.get('average_cost', 0):,.2f}", "现价": f"{CURRENCY_SYMBOLS.get(s.get('currency', 'USD'), '')}{prices.get(s['ticker'], 0):,.2f}", "市值": f"{CURRENCY_SYMBOLS.get(s.get('currency', 'USD'), '')}{s.get('quantity', 0) * prices.get(s['ticker'], 0):,.2f}", "未实现盈亏": f"{CURRENCY_SYMBOLS.get(s.get('currency', 'USD'), '')}{(s.get('quantity', 0) * prices.get(s['ticker'], 0)) - (s.get('quantity', 0) * s.get('average_cost', 0)):,.2f}", "回报率(%)": f"{(((s.get('quantity', 0) * prices.get(s['ticker'], 0)) - (s.get('quantity', 0) * s.get('average_cost', 0))) / (s.get('quantity', 0) * s.get('average_cost', 0)) * 100) if (s.get('quantity', 0) * s.get('average_cost', 0)) > 0 else 0:.2f}%"} for s in stock_holdings]
-    crypto_df_data = [{"代码": c['symbol'], "数量": f"{c.get('quantity',0):.6f}", "成本价": f"${c.get('average_cost', 0):,.2f}", "现价": f"${prices.get(c['symbol'], 0):,.2f}", "市值": f"${c.get('quantity', 0) * prices.get(c['symbol'], 0):,.2f}", "未实现盈亏": f"${(c.get('quantity', 0) * prices.get(c['symbol'], 0)) - (c.get('quantity', 0) * c.get('average_cost', 0)):,.2f}", "回报率(%)": f"{(((c.get('quantity', 0) * prices.get(c['symbol'], 0)) - (c.get('quantity', 0) * c.get('average_cost', 0))) / (c.get('quantity', 0) * c.get('average_cost', 0)) * 100) if (c.get('quantity', 0) * c.get('average_cost', 0)) > 0 else 0:.2f}%"} for c in crypto_holdings]
-    gold_df_data = [{"资产": "黄金", "克数 (g)": g.get('grams', 0), "成本价 ($/g)": f"${g.get('average_cost_per_gram', 0):,.2f}", "现价 ($/g)": f"${gold_price_per_gram:,.2f}", "市值": f"${g.get('grams', 0) * gold_price_per_gram:,.2f}", "未实现盈亏": f"${(g.get('grams', 0) * gold_price_per_gram) - (g.get('grams', 0) * g.get('average_cost_per_gram', 0)):,.2f}", "回报率(%)": f"{(((g.get('grams', 0) * gold_price_per_gram) - (g.get('grams', 0) * g.get('average_cost_per_gram', 0))) / (g.get('grams', 0) * g.get('average_cost_per_gram', 0)) * 100) if (g.get('grams', 0) * g.get('average_cost_per_gram', 0)) > 0 else 0:.2f}%"} for g in gold_holdings]
+    stock_df = build_stock_table(stock_holdings, prices)
+    crypto_df = build_crypto_table(crypto_holdings, prices)
+    gold_df = build_gold_table(gold_holdings, gold_price_per_gram)
 
     # --- MODIFICATION: Removed manual transaction tab (tab2) ---
     tab1, tab2, tab3, tab4 = st.tabs(["📊 资产总览", "✍️ 资产编辑与交易", "📈 历史趋势", "🤖 AI深度分析"])
@@ -593,11 +1446,12 @@ def display_dashboard():
         with col2_alloc:
             sector_values = {}
             with st.spinner("正在获取持仓股票的行业信息..."):
-                for s in stock_holdings:
-                    profile = get_stock_profile_yf(s['ticker'])
+                # Look the profiles up concurrently; each one is a separate network round trip.
+                profiles = get_stock_profiles_yf(list(dict.fromkeys(s['ticker'] for s in stock_holdings)))
+                for s, value_usd in zip(stock_holdings, stock_values_usd):
+                    profile = profiles.get(s['ticker'])
                     sector_english = profile.get('sector', 'N/A') if profile else 'N/A'
                     sector_chinese = SECTOR_TRANSLATION.get(sector_english, sector_english)
-                    value_usd = s.get('quantity',0) * prices.get(s['ticker'], 0) / exchange_rates.get(s.get('currency', 'USD'), 1)
                     sector_values[sector_chinese] = sector_values.get(sector_chinese, 0) + value_usd
 
             plot_values = {k: v for k, v in sector_values.items() if v > 0.01}
@@ -613,24 +1467,24 @@ def display_dashboard():
         st.subheader("资产与盈亏明细")
         st.write("📈 **股票持仓**")
         # --- MODIFICATION: Use st.table to remove vertical scrollbar ---
-        st.table(pd.DataFrame(stock_df_data))
+        st.table(stock_df)
         st.write("🥇 **黄金持仓**")
         # --- MODIFICATION: Use st.table to remove vertical scrollbar ---
-        st.table(pd.DataFrame(gold_df_data))
+        st.table(gold_df)
         
         c1, c2, c3 = st.columns(3)
         with c1:
             st.write("💵 **现金账户**")
             # --- MODIFICATION: Switched to st.table to remove internal scrollbar ---
-            st.table(pd.DataFrame([{"账户名称": acc['name'],"货币": acc['currency'], "余额": f"{CURRENCY_SYMBOLS.get(acc['currency'], '')}{acc['balance']:,.2f}"} for acc in cash_accounts]))
+            st.table(build_balance_table(cash_accounts, "账户名称", "余额"))
         with c2:
             st.write("🪙 **加密货币持仓**")
             # --- MODIFICATION: Use st.table to remove vertical scrollbar ---
-            st.table(pd.DataFrame(crypto_df_data))
+            st.table(crypto_df)
         with c3:
             st.write("💳 **负债账户**")
             # --- MODIFICATION: Switched to st.table to remove internal scrollbar ---
-            st.table(pd.DataFrame([{"名称": liab['name'],"货币": liab['currency'], "金额": f"{CURRENCY_SYMBOLS.get(liab['currency'], '')}{liab['balance']:,.2f}"} for liab in liabilities]))
+            st.table(build_balance_table(liabilities, "名称", "金额"))
 
     # --- MODIFICATION: This is the new tab2 (formerly tab3), with all logic combined ---
     with tab2:
@@ -646,8 +1500,10 @@ def display_dashboard():
             return df
         
         # --- MODIFICATION: Added function to find cash account by name ---
+        # Indexed once per run; built in reverse so a duplicated name still resolves to its first account.
+        cash_accounts_by_name = {acc["name"]: acc for acc in reversed(cash_accounts)}
         def get_cash_account(name):
-            return next((acc for acc in cash_accounts if acc["name"] == name), None)
+            return cash_accounts_by_name.get(name)
 
         # --- MODIFICATION: Added function to add transaction ---
         def add_transaction(description, type, amount, currency, account_name, symbol=None, quantity=None, realized_pl=None, pl_currency=None):
@@ -674,7 +1530,7 @@ def display_dashboard():
 
         with edit_tabs[0]:
             schema = {'name': 'object', 'currency': 'object', 'balance': 'float64'}
-            df = to_df_with_schema(user_portfolio.get("cash_accounts",[]), schema)
+            df = to_df_with_schema(cash_accounts, schema)
             
             # Store 'before' state
             cash_before_df = df.copy().set_index('name')
@@ -689,7 +1545,7 @@ def display_dashboard():
                 # Diff logic
                 diff_df = cash_before_df.merge(cash_after_df, on='name', how='outer', suffixes=('_old', '_new'))
                 
-                for name, row in diff_df.iterrows():
+                for name, row in zip(diff_df.index, diff_df.to_dict('records')):
                     balance_old = row.get('balance_old', 0)
                     balance_new = row.get('balance_new', 0)
                     currency = row.get('currency_new', row.get('currency_old', 'USD')) # Get currency
@@ -705,14 +1561,11 @@ def display_dashboard():
 
                 user_portfolio["cash_accounts"] = edited_list
                 
-                # --- MODIFICATION: Explicitly update session state ---
-                st.session_state.user_profile = user_profile
-                
-                if save_user_profile(st.session_state.user_email, user_profile): st.success("现金账户已更新！"); time.sleep(1); st.rerun()
+                commit_user_profile(user_profile, "现金账户已更新！")
         
         with edit_tabs[1]:
             schema = {'name': 'object', 'currency': 'object', 'balance': 'float64'}
-            df = to_df_with_schema(user_portfolio.get("liabilities",[]), schema)
+            df = to_df_with_schema(liabilities, schema)
             calc_height = max(200, (len(df) + 6) * 35 + 3)
             edited_df = st.data_editor(df, num_rows="dynamic", key="liabilities_editor_adv", column_config={"name": "名称", "currency": st.column_config.SelectboxColumn("货币", options=SUPPORTED_CURRENCIES, required=True), "balance": st.column_config.NumberColumn("金额", format="%.2f", required=True)}, use_container_width=True, hide_index=True, height=calc_height)
             
@@ -720,14 +1573,11 @@ def display_dashboard():
                 # Liabilities are simple, no transaction linking needed
                 user_portfolio["liabilities"] = edited_df.dropna(subset=['name']).to_dict('records')
                 
-                # --- MODIFICATION: Explicitly update session state ---
-                st.session_state.user_profile = user_profile
-                
-                if save_user_profile(st.session_state.user_email, user_profile): st.success("负债账户已更新！"); time.sleep(1); st.rerun()
+                commit_user_profile(user_profile, "负债账户已更新！")
 
         with edit_tabs[2]:
             schema = {'ticker': 'object', 'quantity': 'float64', 'average_cost': 'float64', 'currency': 'object'}
-            df = to_df_with_schema(user_portfolio.get("stocks",[]), schema)
+            df = to_df_with_schema(stock_holdings, schema)
             
             # Store 'before' state
             stock_before_df = df.copy().set_index('ticker')
@@ -742,17 +1592,21 @@ def display_dashboard():
                 edited_list = edited_df.dropna(subset=['ticker', 'quantity', 'average_cost']).to_dict('records')
                 
                 # Auto-fetch currency for new tickers
-                original_map = {s['ticker']: s for s in deepcopy(user_portfolio.get("stocks", []))}
+                original_tickers = {s['ticker'] for s in stock_holdings}
                 invalid_new_tickers = []
-                for holding in edited_list:
-                    holding['ticker'] = holding['ticker'].upper()
-                    if (holding['ticker'] not in original_map) or (not holding.get('currency')):
-                        with st.spinner(f"正在验证 {holding['ticker']}..."):
-                            profile = get_stock_profile_yf(holding['ticker'])
-                        if profile and profile.get('currency'):
-                            holding['currency'] = profile['currency'].upper()
-                        else:
-                            invalid_new_tickers.append(holding['ticker'])
+                with st.spinner("正在验证股票代码..."):
+                    for holding in edited_list:
+                        holding['ticker'] = holding['ticker'].strip().upper()
+                    # Look up every ticker that needs a profile concurrently, each only once.
+                    lookup_tickers = list(dict.fromkeys(h['ticker'] for h in edited_list if h['ticker'] not in original_tickers or not h.get('currency')))
+                    lookup_profiles = get_stock_profiles_yf(lookup_tickers)
+                    for holding in edited_list:
+                        if holding['ticker'] in lookup_profiles:
+                            profile = lookup_profiles[holding['ticker']]
+                            if profile and profile.get('currency'):
+                                holding['currency'] = profile['currency'].upper()
+                            else:
+                                invalid_new_tickers.append(holding['ticker'])
                 if invalid_new_tickers:
                     st.error(f"以下新增的代码无效或无法获取信息: {', '.join(invalid_new_tickers)}")
                     st.stop()
@@ -761,8 +1615,9 @@ def display_dashboard():
                 stock_after_df = pd.DataFrame(edited_list).set_index('ticker')
                 diff_df = stock_before_df.merge(stock_after_df, on='ticker', how='outer', suffixes=('_old', '_new'))
                 cash_acct = get_cash_account(cash_account_stock)
+                cash_rate = exchange_rates.get(cash_acct['currency'], 1)
                 
-                for ticker, row in diff_df.iterrows():
+                for ticker, row in zip(diff_df.index, diff_df.to_dict('records')):
                     qty_old = row.get('quantity_old', 0)
                     qty_new = row.get('quantity_new', 0)
                     cost_old = row.get('average_cost_old', 0)
@@ -773,21 +1628,21 @@ def display_dashboard():
                     
                     if pd.isna(qty_old): # New holding (Buy)
                         amount = qty_new * cost_new
-                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 买入 {ticker}", "买入股票", amount, cash_acct['currency'], cash_acct['name'], ticker, qty_new)
                     
                     elif pd.isna(qty_new): # Sold all (Sell)
                         current_price = prices.get(ticker, 0)
                         amount = qty_old * current_price # Sell at market price
                         realized_pl = (current_price - cost_old) * qty_old
-                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 卖出 {ticker}", "卖出股票", amount, cash_acct['currency'], cash_acct['name'], ticker, qty_old, realized_pl, currency)
 
                     elif qty_diff > 0: # Bought more
                         cost_basis_old = qty_old * cost_old
                         cost_basis_new = qty_new * cost_new
                         amount = cost_basis_new - cost_basis_old # Inferred cost
-                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 买入 {ticker}", "买入股票", amount, cash_acct['currency'], cash_acct['name'], ticker, qty_diff)
 
                     elif qty_diff < 0: # Sold some
@@ -795,19 +1650,16 @@ def display_dashboard():
                         current_price = prices.get(ticker, 0)
                         amount = qty_sold * current_price # Sell at market price
                         realized_pl = (current_price - cost_old) * qty_sold # P/L based on original avg cost
-                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 卖出 {ticker}", "卖出股票", amount, cash_acct['currency'], cash_acct['name'], ticker, qty_sold, realized_pl, currency)
 
                 user_portfolio["stocks"] = edited_list
                 
-                # --- MODIFICATION: Explicitly update session state ---
-                st.session_state.user_profile = user_profile
-                
-                if save_user_profile(st.session_state.user_email, user_profile): st.success("股票持仓已更新，并已自动生成流水！"); time.sleep(1); st.rerun()
+                commit_user_profile(user_profile, "股票持仓已更新，并已自动生成流水！")
 
         with edit_tabs[3]:
             schema = {'symbol': 'object', 'quantity': 'float64', 'average_cost': 'float64'}
-            df = to_df_with_schema(user_portfolio.get("crypto",[]), schema)
+            df = to_df_with_schema(crypto_holdings, schema)
             
             # Store 'before' state
             crypto_before_df = df.copy().set_index('symbol')
@@ -820,15 +1672,16 @@ def display_dashboard():
 
             if st.button("💾 保存加密货币修改", key="save_crypto", disabled=(not cash_account_names[0] != "-")):
                 edited_list = edited_df.dropna(subset=['symbol', 'quantity', 'average_cost']).to_dict('records')
-                for holding in edited_list: holding['symbol'] = holding['symbol'].upper()
+                for holding in edited_list: holding['symbol'] = holding['symbol'].strip().upper()
                 
                 # Diff logic
                 crypto_after_df = pd.DataFrame(edited_list).set_index('symbol')
                 diff_df = crypto_before_df.merge(crypto_after_df, on='symbol', how='outer', suffixes=('_old', '_new'))
                 cash_acct = get_cash_account(cash_account_crypto)
+                cash_rate = exchange_rates.get(cash_acct['currency'], 1)
                 # Crypto is simpler, avg_cost and prices are all USD
                 
-                for symbol, row in diff_df.iterrows():
+                for symbol, row in zip(diff_df.index, diff_df.to_dict('records')):
                     qty_old = row.get('quantity_old', 0)
                     qty_new = row.get('quantity_new', 0)
                     cost_old = row.get('average_cost_old', 0)
@@ -839,21 +1692,21 @@ def display_dashboard():
                     
                     if pd.isna(qty_old): # New holding (Buy)
                         amount = qty_new * cost_new
-                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 买入 {symbol}", "买入加密货币", amount, cash_acct['currency'], cash_acct['name'], symbol, qty_new)
                     
                     elif pd.isna(qty_new): # Sold all (Sell)
                         current_price = prices.get(symbol, 0)
                         amount = qty_old * current_price # Sell at market price
                         realized_pl = (current_price - cost_old) * qty_old
-                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 卖出 {symbol}", "卖出加密货币", amount, cash_acct['currency'], cash_acct['name'], symbol, qty_old, realized_pl, currency)
 
                     elif qty_diff > 0: # Bought more
                         cost_basis_old = qty_old * cost_old
                         cost_basis_new = qty_new * cost_new
                         amount = cost_basis_new - cost_basis_old # Inferred cost
-                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 买入 {symbol}", "买入加密货币", amount, cash_acct['currency'], cash_acct['name'], symbol, qty_diff)
 
                     elif qty_diff < 0: # Sold some
@@ -861,23 +1714,20 @@ def display_dashboard():
                         current_price = prices.get(symbol, 0)
                         amount = qty_sold * current_price # Sell at market price
                         realized_pl = (current_price - cost_old) * qty_sold # P/L based on original avg cost
-                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                        cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * cash_rate
                         add_transaction(f"[自动] 卖出 {symbol}", "卖出加密货币", amount, cash_acct['currency'], cash_acct['name'], symbol, qty_sold, realized_pl, currency)
 
                 user_portfolio["crypto"] = edited_list
                 
-                # --- MODIFICATION: Explicitly update session state ---
-                st.session_state.user_profile = user_profile
-                
-                if save_user_profile(st.session_state.user_email, user_profile): st.success("加密货币持仓已更新，并已自动生成流水！"); time.sleep(1); st.rerun()
+                commit_user_profile(user_profile, "加密货币持仓已更新，并已自动生成流水！")
         
         with edit_tabs[4]:
             st.info("记录您持有的实物或纸黄金。成本价请以美元/克计价。")
             schema = {'grams': 'float64', 'average_cost_per_gram': 'float64'}
-            df = to_df_with_schema(user_portfolio.get("gold",[]), schema)
+            df = to_df_with_schema(gold_holdings, schema)
             
             # Store 'before' state
-            gold_before_df = pd.DataFrame(user_portfolio.get("gold",[])) # Gold is a list of dicts, no unique index
+            gold_before_df = pd.DataFrame(gold_holdings) # Gold is a list of dicts, no unique index
 
             calc_height = max(200, (len(df) + 6) * 35 + 3)
             edited_df = st.data_editor(df, num_rows="dynamic", key="gold_editor_adv", column_config={"grams": st.column_config.NumberColumn("克数 (g)", format="%.3f", required=True), "average_cost_per_gram": st.column_config.NumberColumn("平均成本 ($/g)", format="%.2f", required=True)}, use_container_width=True, hide_index=True, height=calc_height)
@@ -899,12 +1749,13 @@ def display_dashboard():
                 avg_cost_new = (cost_basis_new / grams_new) if grams_new > 0 else 0
 
                 cash_acct = get_cash_account(cash_account_gold)
+                cash_rate = exchange_rates.get(cash_acct['currency'], 1)
                 currency = "USD" # Gold cost basis is USD
                 qty_diff = grams_new - grams_old
 
                 if qty_diff > 0: # Bought Gold
                     amount = cost_basis_new - cost_basis_old
-                    cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                    cash_acct['balance'] -= (amount / exchange_rates.get(currency, 1)) * cash_rate
                     add_transaction(f"[自动] 买入黄金", "买入黄金", amount, cash_acct['currency'], cash_acct['name'], "GOLD (g)", qty_diff)
                 
                 elif qty_diff < 0: # Sold Gold
@@ -912,174 +1763,24 @@ def display_dashboard():
                     current_price = gold_price_per_gram
                     amount = qty_sold * current_price # Sell at market price
                     realized_pl = (current_price - avg_cost_old) * qty_sold
-                    cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * exchange_rates.get(cash_acct['currency'], 1)
+                    cash_acct['balance'] += (amount / exchange_rates.get(currency, 1)) * cash_rate
                     add_transaction(f"[自动] 卖出黄金", "卖出黄金", amount, cash_acct['currency'], cash_acct['name'], "GOLD (g)", qty_sold, realized_pl, currency)
 
                 user_portfolio["gold"] = edited_list
                 
-                # --- MODIFICATION: Explicitly update session state ---
-                st.session_state.user_profile = user_profile
-                
-                if save_user_profile(st.session_state.user_email, user_profile): st.success("黄金持仓已更新，并已自动生成流水！"); time.sleep(1); st.rerun()
+                commit_user_profile(user_profile, "黄金持仓已更新，并已自动生成流水！")
 
         st.subheader("📑 交易流水")
-        transactions = user_profile.get("transactions", [])
-        if transactions:
-            transactions_df = pd.DataFrame(transactions).sort_values(by="date", ascending=False)
-            
-            # Format columns for better display
-            if 'symbol' not in transactions_df.columns: transactions_df['symbol'] = pd.NA
-            if 'quantity' not in transactions_df.columns: transactions_df['quantity'] = pd.NA
-            if 'realized_pl' not in transactions_df.columns: transactions_df['realized_pl'] = pd.NA
-            if 'pl_currency' not in transactions_df.columns: transactions_df['pl_currency'] = pd.NA
-            
-            display_cols = ["date", "type", "description", "amount", "currency", "account", "symbol", "quantity", "realized_pl", "pl_currency"]
-            # Filter out columns that are entirely empty
-            display_cols = [col for col in display_cols if col in transactions_df.columns and not transactions_df[col].isnull().all()]
-            
-            st.table(transactions_df[display_cols])
-        else:
-            st.write("暂无交易记录。")
+        display_transaction_log(user_profile.get("transactions", []))
 
 
     # --- MODIFICATION: This is now tab3 (formerly tab4) ---
     with tab3:
-        st.subheader("📈 资产历史趋势")
+        display_history_chart(history_df, display_curr, display_rate, display_symbol)
 
-        chart_type = st.radio(
-            "选择图表类型",
-            ('市值', '回报率 (%)'),
-            horizontal=True,
-            key='history_chart_type'
-        )
-
-        if history_df.empty or len(history_df.index) < 2:
-            st.info("历史数据不足（少于2天），无法生成图表。")
-        else:
-            with st.spinner("正在生成历史趋势图..."):
-                plot_df = history_df.copy()
-                
-                if chart_type == '回报率 (%)':
-                    # Normalize data to show percentage change
-                    plot_df = (plot_df / plot_df.iloc[0]) * 100
-                    yaxis_title = "回报率 (%)"
-                    hovertemplate_prefix = ""
-                    hovertemplate_suffix = "%"
-                else: # Default is '市值'
-                    plot_df = plot_df.mul(display_rate)
-                    yaxis_title = f"市值 ({display_symbol})"
-                    hovertemplate_prefix = display_symbol
-                    hovertemplate_suffix = f" {display_curr}"
-
-                fig = go.Figure()
-                categories = {
-                    'net_worth_usd': '总净资产',
-                    'stock_value_usd': '股票',
-                    'crypto_value_usd': '加密货币',
-                    'gold_value_usd': '黄金',
-                    'cash_value_usd': '现金'
-                }
-                
-                # Store colors to match text with lines
-                colors = px.colors.qualitative.Plotly
-                
-                for i, (key, name) in enumerate(categories.items()):
-                    color = colors[i % len(colors)]
-                    fig.add_trace(go.Scatter(
-                        x=plot_df.index,
-                        y=plot_df[key],
-                        mode='lines',
-                        name=name,
-                        line=dict(color=color), # Assign color
-                        hovertemplate=f"日期: %{{x|%Y-%m-%d}}<br>{name}: {hovertemplate_prefix}%{{y:,.2f}}{hovertemplate_suffix}<extra></extra>"
-                    ))
-
-                    # Add text label for the last point
-                    last_val = plot_df[key].iloc[-1]
-                    text_label = f"{hovertemplate_prefix}{last_val:,.2f}{hovertemplate_suffix}"
-                    if chart_type == '回报率 (%)':
-                         text_label = f"{last_val:,.2f}{hovertemplate_suffix}"
-
-                    fig.add_trace(go.Scatter(
-                        x=[plot_df.index[-1]],
-                        y=[last_val],
-                        text=[text_label],
-                        mode='text',
-                        textposition='middle right',
-                        textfont=dict(color=color, size=12),
-                        showlegend=False,
-                        hoverinfo='none'
-                    ))
-                
-                fig.update_layout(
-                    title_text=f"资产{chart_type}历史趋势",
-                    yaxis_title=yaxis_title,
-                    hovermode="x unified",
-                    margin=dict(r=100) # Add right margin to make space for text
-                )
-                st.plotly_chart(fig, use_container_width=True)
-                
     # --- MODIFICATION: This is now tab4 (formerly tab5) ---
     with tab4:
-        st.subheader("🤖 AI 深度分析")
-        st.info("此功能会将您匿名的持仓明细发送给AI进行全面分析，以提供更具洞察力的建议。")
-        
-        stock_table = pd.DataFrame(stock_df_data).to_markdown(index=False)
-        gold_table = pd.DataFrame(gold_df_data).to_markdown(index=False)
-        crypto_table = pd.DataFrame(crypto_df_data).to_markdown(index=False)
-        cash_table = pd.DataFrame([{"账户名称": acc['name'], "货币": acc['currency'], "余额": f"{acc['balance']:,.2f}"} for acc in cash_accounts]).to_markdown(index=False)
-        liabilities_table = pd.DataFrame([{"名称": liab['name'], "货币": liab['currency'], "金额": f"{liab['balance']:,.2f}"} for liab in liabilities]).to_markdown(index=False)
-
-        prompt = f"""# 角色
-你是一位资深、专业的中文投资组合分析师。你的任务是为客户提供详细、专业且易于理解的投资组合诊断报告。
-
-# 输出要求
-- **语言**: 全程必须使用**简体中文**进行分析和回答。
-- **格式**: 使用Markdown格式，分点阐述，条理清晰。
-- **语气**: 专业、客观、鼓励，并提供可执行的建议。
-- **详细程度**: 对每个分析要点进行详细阐述，不要只给出结论，要解释原因。
-
-# 核心分析任务
-请根据下面提供的匿名投资组合数据，完成一份详细的诊断报告，报告需包含以下部分：
-1.  **总体概览**: 对当前资产规模、净资产、负债水平和资产构成进行简要总结。
-2.  **投资组合优点 (Strengths)**: 找出当前持仓中值得肯定的地方（例如，良好的多元化、持有了优质资产等）。
-3.  **潜在风险与弱点 (Weaknesses & Risks)**: 识别并详细说明当前投资组合存在的问题，例如：
-    * **集中度风险**: 是否有单一资产（股票或加密货币）或单一行业占比过高？
-    * **流动性分析**: 现金及高流动性资产的比例是否合理？
-    * **资产质量**: 持仓中低、中、高风险资产的比例？预期收益率和亏损概率分别是多少？
-4.  **具体优化建议**: 提供3-5条具体的、可立即执行的调整建议。例如：“建议考虑减持部分 [某股票]，因为它在您的投资组合中占比已超过XX%，风险过于集中。可以将资金再平衡到 [某行业/ETF] 以提高多元化。”
-
----
-
-# 客户的匿名投资组合数据
-(所有金额单位均为 {display_curr})
-
-## 财务摘要
-- **总资产**: {display_symbol}{total_assets_usd * display_rate:,.2f}
-- **总负债**: {display_symbol}{total_liabilities_usd * display_rate:,.2f}
-- **净资产**: {display_symbol}{net_worth_usd * display_rate:,.2f}
-
-## 详细持仓
-
-### 股票持仓
-{stock_table}
-
-### 黄金持仓
-{gold_table}
-
-### 加密货币持仓
-{crypto_table}
-
-### 现金账户
-{cash_table}
-
-### 负债情况
-{liabilities_table}
-"""
-        if st.button("开始 AI 分析"):
-            with st.spinner("正在调用 AI 进行深度分析，请稍候..."):
-                analysis_result = get_detailed_ai_analysis(prompt)
-                st.markdown(analysis_result)
+        display_ai_analysis(stock_df, gold_df, crypto_df, cash_accounts, liabilities, total_assets_usd, total_liabilities_usd, net_worth_usd, display_curr, display_rate, display_symbol)
 
 # --- Main App Logic ---
 check_session_from_query_params()